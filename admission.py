@@ -0,0 +1,253 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import suppress
+from starlette.datastructures import Headers
+from starlette.routing import compile_path
+from fastapi.responses import ORJSONResponse
+from metrics import ADMISSION_WAIT_SECONDS, ADMISSION_REJECTED, ADMISSION_QUEUED, ADMISSION_ACTIVE
+from business.utils import MAX_FILE_SIZE, MAX_UPLOAD_IMAGES
+
+# Config
+RATE_LIMIT_URL = os.getenv('RATE_LIMIT_URL')  # e.g. redis://localhost:6379/1, per process when unset
+RATE_LIMITING = os.getenv('RATE_LIMITING', 'true').lower() != 'false'
+RATE_LIMIT_MAX_KEYS = 10000  # buckets an in-memory limiter keeps, least recently used go first
+# Slots are per process, they guard this process's bcrypt threads and image workers
+PASSWORD_SLOTS = int(os.getenv('PASSWORD_SLOTS', 2 * (os.cpu_count() or 1)))
+UPLOAD_SLOTS = int(os.getenv('UPLOAD_SLOTS', os.cpu_count() or 1))
+ADMISSION_QUEUE = int(os.getenv('ADMISSION_QUEUE', 8))  # waiting requests per slot before a 503
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 5))  # seconds
+ADMISSION_RETRY_AFTER = 2  # seconds, sent with a 503
+MULTIPART_OVERHEAD = 64 * 1024  # bytes of boundaries and part headers allowed per upload
+
+logger = logging.getLogger(__name__)
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: float = ADMISSION_RETRY_AFTER):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimit:
+    # Requests past `slots` wait in line, at most `queue` of them and for at most `timeout` seconds
+    def __init__(self, name: str, slots: int, queue: int, timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.slots = slots
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    def _report(self):
+        ADMISSION_ACTIVE.labels(self.name).set(self.active)
+        ADMISSION_QUEUED.labels(self.name).set(len(self._waiters))
+
+    async def acquire(self) -> float:
+        # Returns the seconds spent waiting
+        if self.active < self.slots and not self._waiters:
+            self.active += 1
+            self._report()
+            return 0.0
+        if len(self._waiters) >= self.queue:
+            raise Rejected('queue_full')
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._report()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot just as the wait ended, it goes to the next in line
+                self.release()
+            else:
+                with suppress(ValueError):
+                    self._waiters.remove(waiter)
+                self._report()
+            if isinstance(e, asyncio.TimeoutError):
+                raise Rejected('queue_timeout') from None
+            raise
+        return time.perf_counter() - start
+
+    def release(self):
+        # The slot passes straight to the oldest waiter, a new arrival can't overtake the line
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._report()
+                return
+        self.active -= 1
+        self._report()
+
+
+class MemoryRateLimiter:
+    # Token buckets of this process, key -> (tokens, updated_at)
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        # Seconds until a token is available, 0 when one was taken
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+# Refill and take in one step, the result is a string since Lua numbers come back as integers
+_TAKE_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisRateLimiter:
+    # Shared by every process, works with any client exposing the redis.asyncio register_script call
+    def __init__(self, client):
+        self._take = client.register_script(_TAKE_SCRIPT)
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        return float(await self._take(keys=[key], args=[rate, burst, time.time()]))
+
+
+def create_rate_limiter():
+    if RATE_LIMIT_URL:
+        import redis.asyncio as redis
+        return RedisRateLimiter(redis.from_url(RATE_LIMIT_URL))
+    return MemoryRateLimiter()
+
+
+class Policy:
+    # `per_minute` requests per client once its `burst` is spent; clients are users with a valid
+    # token when `per_user`, addresses otherwise. Bodies declared larger than `max_body` bytes are
+    # refused before they are read
+    def __init__(self, name: str, method: str, path: str, per_minute: float | None = None, burst: int = 1,
+                 limit: ConcurrencyLimit | None = None, per_user: bool = True, max_body: int | None = None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.pattern = compile_path(path)[0]
+        self.rate = per_minute / 60 if per_minute else None
+        self.burst = burst
+        self.limit = limit
+        self.per_user = per_user
+        self.max_body = max_body
+
+
+password_slots = ConcurrencyLimit('password', PASSWORD_SLOTS, ADMISSION_QUEUE * PASSWORD_SLOTS)
+upload_slots = ConcurrencyLimit('upload', UPLOAD_SLOTS, ADMISSION_QUEUE * UPLOAD_SLOTS)
+
+POLICIES = [
+    Policy('login', 'POST', '/user-api/token', per_minute=10, burst=10, limit=password_slots, per_user=False),
+    Policy('signup', 'POST', '/user-api/signup', per_minute=5, burst=5, limit=password_slots, per_user=False),
+    Policy('verify-email', 'POST', '/user-api/verify-email', per_minute=1, burst=3),
+    Policy('business-logo', 'PUT', '/business/{business_id}/logo', per_minute=30, burst=10,
+           limit=upload_slots, max_body=MAX_FILE_SIZE + MULTIPART_OVERHEAD),
+    Policy('product-images', 'PUT', '/product/{product_id}/product-images', per_minute=30, burst=10,
+           limit=upload_slots, max_body=MAX_UPLOAD_IMAGES * (MAX_FILE_SIZE + MULTIPART_OVERHEAD)),
+]
+
+
+def find_policy(policies: list[Policy], method: str, path: str) -> Policy | None:
+    for policy in policies:
+        if policy.method == method and policy.pattern.match(path):
+            return policy
+    return None
+
+
+def _rejection(rejected: Rejected) -> ORJSONResponse:
+    if rejected.reason == 'too_large':
+        # Sending it again won't help, no Retry-After
+        return ORJSONResponse({'detail': 'Upload exceeds the maximum size'}, status_code=413)
+    if rejected.reason == 'rate_limited':
+        status_code, detail = 429, 'Too many requests, try again later'
+    else:
+        status_code, detail = 503, 'Server is busy, try again later'
+    return ORJSONResponse({'detail': detail}, status_code=status_code,
+                          headers={'Retry-After': str(max(1, math.ceil(rejected.retry_after)))})
+
+
+class AdmissionMiddleware:
+    # Plain ASGI like MetricsMiddleware: expensive routes are turned away before the body is read
+    # and before any database or bcrypt work, everything else passes straight through.
+    # `identify` maps a bearer token to a user id, None when the token isn't valid
+    def __init__(self, app, identify=None, policies: list[Policy] = POLICIES, limiter=None):
+        self.app = app
+        self.identify = identify
+        self.policies = policies
+        self.limiter = limiter or create_rate_limiter()
+
+    def client_key(self, policy: Policy, scope) -> str:
+        if policy.per_user and self.identify:
+            scheme, _, token = Headers(scope=scope).get('authorization', '').partition(' ')
+            if scheme.lower() == 'bearer' and token:
+                user_id = self.identify(token)
+                if user_id is not None:
+                    return f'user:{user_id}'
+        # Behind a proxy uvicorn's --proxy-headers puts the real client here
+        client = scope.get('client')
+        return f'ip:{client[0] if client else "unknown"}'
+
+    def _check_size(self, policy: Policy, scope):
+        # Chunked bodies carry no length, the upload routes still check every file as it is read
+        length = Headers(scope=scope).get('content-length')
+        if policy.max_body and length and length.isdigit() and int(length) > policy.max_body:
+            raise Rejected('too_large')
+
+    async def _rate_limit(self, policy: Policy, scope):
+        key = f'ratelimit:{policy.name}:{self.client_key(policy, scope)}'
+        try:
+            wait = await self.limiter.take(key, policy.rate, policy.burst)
+        except Exception:
+            # A limiter that can't be reached lets requests through, the slots still apply
+            logger.warning('Rate limiter unavailable, admitting %s', policy.name, exc_info=True)
+            return
+        if wait > 0:
+            raise Rejected('rate_limited', wait)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        policy = find_policy(self.policies, scope['method'], scope['path'])
+        if policy is None:
+            return await self.app(scope, receive, send)
+        try:
+            self._check_size(policy, scope)
+            if policy.rate and RATE_LIMITING:
+                await self._rate_limit(policy, scope)
+            waited = await policy.limit.acquire() if policy.limit else None
+        except Rejected as rejected:
+            ADMISSION_REJECTED.labels(policy.name, rejected.reason).inc()
+            # Labels the request metrics, the router never saw it
+            scope['route'] = policy
+            return await _rejection(rejected)(scope, receive, send)
+        if policy.limit is None:
+            return await self.app(scope, receive, send)
+        ADMISSION_WAIT_SECONDS.labels(policy.name).observe(waited)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            policy.limit.release()
@@ -0,0 +1,138 @@
+# Starts the app in fresh uvicorn processes and times how long each takes to answer.
+# Run from the repository root:
+#   python -m benchmarks.cold_start --save-baseline benchmarks/cold_start.json
+#   python -m benchmarks.cold_start --baseline benchmarks/cold_start.json   # exits 1 on a regression
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import tempfile
+import urllib.request
+import urllib.error
+from benchmarks.run import compare
+
+# Config
+FIRST_REQUEST = '/product/?limit=1'  # goes through routing, the read pool and serialization
+POLL_INTERVAL = 0.005  # seconds between attempts while the server is starting
+START_TIMEOUT = 60  # seconds
+# Compared against a saved baseline: a slower start or a larger process beyond the threshold fails
+COMPARED_METRICS = {'import_ms': 1, 'first_response_ms': 1, 'rss_mb': 1}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='EasyShop cold start benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--baseline', metavar='PATH')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed regression, 0.2 = 20%%')
+    return parser.parse_args()
+
+
+def environment(db_dir: str) -> dict:
+    return {**os.environ, 'DATABASE_URL': f"sqlite+aiosqlite:///{os.path.join(db_dir, 'bench.db')}",
+            'SECRET_KEY': os.environ.get('SECRET_KEY', 'benchmark'), 'SLOW_REQUEST_SECONDS': 'inf'}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid: int) -> float | None:
+    # Linux only, the resident set of that one process
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        return None
+    return None
+
+
+def import_ms(env: dict) -> float:
+    # What every worker, test run and script pays before doing anything
+    code = 'import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)'
+    output = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return float(output.split()[-1]) * 1000
+
+
+def start_server(env: dict) -> tuple[float, float | None]:
+    # Process start to the first 200, lifespan startup included
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1',
+                               '--port', str(port), '--log-level', 'warning'], env=env)
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f'Server exited with code {server.returncode}')
+            if time.perf_counter() - start > START_TIMEOUT:
+                raise RuntimeError('Server did not answer in time')
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}{FIRST_REQUEST}') as response:
+                    if response.status == 200:
+                        break
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(POLL_INTERVAL)
+        elapsed = time.perf_counter() - start
+        return elapsed * 1000, rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def benchmark(args) -> dict:
+    env = environment(tempfile.mkdtemp(prefix='easyshop-cold-'))
+    # Untimed, creates the schema so the timed starts find an up to date database
+    start_server(env)
+    imports, first_responses, rss = [], [], []
+    for _ in range(args.runs):
+        imports.append(import_ms(env))
+        first_response, process_rss = start_server(env)
+        first_responses.append(first_response)
+        if process_rss is not None:
+            rss.append(process_rss)
+    result = {'runs': args.runs, 'import_ms': statistics.median(imports),
+              'first_response_ms': statistics.median(first_responses),
+              'first_response_max_ms': max(first_responses)}
+    if rss:
+        result['rss_mb'] = statistics.median(rss)
+    return {'cold start': result}
+
+
+def print_results(results: dict):
+    print(f"{'scenario':<16}{'runs':>6}{'import ms':>11}{'first resp ms':>15}{'max ms':>9}{'rss MB':>8}")
+    for name, r in results.items():
+        rss = f"{r['rss_mb']:>8.0f}" if 'rss_mb' in r else f"{'n/a':>8}"
+        print(f"{name:<16}{r['runs']:>6}{r['import_ms']:>11.0f}{r['first_response_ms']:>15.0f}"
+              f"{r['first_response_max_ms']:>9.0f}{rss}")
+
+
+def main() -> int:
+    args = parse_args()
+    results = benchmark(args)
+    print_results(results)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Baseline saved to {args.save_baseline}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold, COMPARED_METRICS)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+        print(f'No regression beyond {args.threshold:.0%} of the baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+# Seeds a throwaway database and drives the real app in-process through ASGI.
+# Run from the repository root:
+#   python -m benchmarks.run --save-baseline benchmarks/baseline.json
+#   python -m benchmarks.run --baseline benchmarks/baseline.json   # exits 1 on a regression
+import os
+import io
+import sys
+import json
+import time
+import random
+import datetime
+from decimal import Decimal
+import asyncio
+import argparse
+import itertools
+import resource
+import tempfile
+
+# Config
+PASSWORD = 'Bench-pass1!'
+WORDS = ['red', 'blue', 'green', 'classic', 'sport', 'leather', 'cotton', 'mini', 'pro', 'ultra']
+ITEMS = ['shoe', 'shirt', 'bag', 'watch', 'lamp', 'phone', 'chair', 'mug']
+CATEGORIES = ['Shoes', 'Clothes', 'Bags', 'Watches', 'Home', 'Electronics', 'General']
+CITIES = ['Cairo', 'Giza', 'Alexandria', 'Luxor']
+REGIONS = ['North', 'South', 'East', 'West']
+PRODUCT_FILTERS = {'name': 'shoe', 'category': 'Shoes', 'price_le': 500, 'price_ge': 50}
+# Compared against a saved baseline: slower p95 or lower throughput beyond the threshold fails
+COMPARED_METRICS = {'p95_ms': 1, 'rps': -1}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='EasyShop benchmarks')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--businesses-per-user', type=int, default=2)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--images', type=int, default=3, help='images per upload request')
+    parser.add_argument('--cache', action='store_true', help='keep the listing cache on')
+    parser.add_argument('--only', help='run scenarios whose name contains this text')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--baseline', metavar='PATH')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed regression, 0.2 = 20%%')
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    # Must run before any app module is imported, they read their settings at import time
+    db_dir = tempfile.mkdtemp(prefix='easyshop-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite+aiosqlite:///{os.path.join(db_dir, 'bench.db')}"
+    # Uploaded variants stay out of static/images
+    os.environ['STORAGE_DIR'] = os.path.join(db_dir, 'images')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['SLOW_REQUEST_SECONDS'] = 'inf'
+    # Every request comes from one client, rate limits would only measure 429s
+    os.environ['RATE_LIMITING'] = 'false'
+    if not args.cache:
+        # Every listing request goes to the database
+        os.environ['CACHE_MAX_ENTRIES'] = '0'
+
+
+async def seed(args) -> dict:
+    from sqlalchemy import insert
+    from database import SessionLocal
+    from models import User, Business, Product
+    from users.auth import hash_password
+    from business.search import index_products
+    from business.typeahead import load_typeahead
+
+    rng = random.Random(args.seed)
+    # One hash for every user, seeding shouldn't spend minutes in bcrypt
+    password = await hash_password(PASSWORD)
+    async with SessionLocal() as db:
+        user_ids = (await db.scalars(insert(User).returning(User.user_id), [
+            {'username': f'bench{i}', 'email': f'bench{i}@example.com', 'password': password,
+             'is_verified': True} for i in range(args.users)])).all()
+        business_ids = (await db.scalars(insert(Business).returning(Business.business_id), [
+            {'business_name': f'Bench shop {user_id}-{i}', 'city': rng.choice(CITIES),
+             'region': rng.choice(REGIONS), 'owner_id': user_id}
+            for user_id in user_ids for i in range(args.businesses_per_user)])).all()
+        products = []
+        for i in range(args.products):
+            price = round(rng.uniform(5, 1000), 2)
+            products.append({'name': f'{rng.choice(WORDS)} {rng.choice(ITEMS)} {i}',
+                             'category': rng.choice(CATEGORIES), 'price': price,
+                             'business_id': rng.choice(business_ids)})
+            if rng.random() < 0.2:
+                discounted = round(price * 0.8, 2)
+                products[-1].update(_discounted_price=discounted, discount=20)
+        product_ids = []
+        for start in range(0, len(products), 1000):
+            batch = (await db.scalars(insert(Product).returning(Product.product_id),
+                                      products[start:start + 1000])).all()
+            await index_products(db, batch)
+            product_ids.extend(batch)
+        # The upload scenario needs a product owned by the first user
+        upload_product = (await db.scalars(insert(Product).returning(Product.product_id), [
+            {'name': 'upload target', 'price': 1, 'business_id': business_ids[0]}])).one()
+        await db.commit()
+    # The lifespan built the typeahead index before these rows existed
+    await load_typeahead()
+    return {'users': len(user_ids), 'businesses': len(business_ids),
+            'products': len(product_ids), 'upload_product': upload_product}
+
+
+def _png(rng: random.Random, size=(1024, 768)) -> bytes:
+    from PIL import Image
+    image = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _subsets(filters: dict):
+    for size in range(len(filters) + 1):
+        for names in itertools.combinations(filters, size):
+            yield {name: filters[name] for name in names}
+
+
+def scenarios(args, seeded: dict, token: str):
+    # (name, request kwargs factory, concurrency)
+    from business.utils import IMAGE_QUEUE_DEPTH
+
+    rng = random.Random(args.seed)
+    users = itertools.cycle(range(seeded['users']))
+    yield 'POST /user-api/token', lambda: {
+        'method': 'POST', 'url': '/user-api/token',
+        'data': {'username': f'bench{next(users)}', 'password': PASSWORD}}, args.concurrency
+    for filters in _subsets(PRODUCT_FILTERS):
+        label = ','.join(filters) or 'no filters'
+        yield f'GET /product/ [{label}]', lambda filters=filters: {
+            'method': 'GET', 'url': '/product/', 'params': filters}, args.concurrency
+    yield 'GET /product/search', lambda: {
+        'method': 'GET', 'url': '/product/search', 'params': {'q': rng.choice(ITEMS)}}, args.concurrency
+    # What a search box sends after one to three keystrokes
+    yield 'GET /product/suggest', lambda: {
+        'method': 'GET', 'url': '/product/suggest',
+        'params': {'q': rng.choice(WORDS + ITEMS)[:rng.randint(1, 3)]}}, args.concurrency
+    yield 'GET /business/', lambda: {'method': 'GET', 'url': '/business/'}, args.concurrency
+    yield 'GET /business/ [city,region]', lambda: {
+        'method': 'GET', 'url': '/business/',
+        'params': {'city': rng.choice(CITIES), 'region': rng.choice(REGIONS)}}, args.concurrency
+    images = [_png(rng) for _ in range(args.images)]
+    # More uploads in flight than the image queue admits would only measure the 503s
+    upload_concurrency = max(1, min(args.concurrency, IMAGE_QUEUE_DEPTH // args.images))
+    uploads = itertools.count()
+
+    def upload(unique: bool):
+        # Bytes after the PNG end are ignored by the decoder but change the content hash
+        suffix = next(uploads).to_bytes(8, 'big') if unique else b''
+        return {'method': 'PUT', 'url': f"/product/{seeded['upload_product']}/product-images",
+                'headers': {'Authorization': f'Bearer {token}'},
+                'files': [('images', (f'{i}.png', image + suffix, 'image/png'))
+                          for i, image in enumerate(images)]}
+    yield f'PUT /product/{{id}}/product-images [{args.images} images]', lambda: upload(True), upload_concurrency
+    yield f'PUT /product/{{id}}/product-images [{args.images} known images]', lambda: upload(False), \
+        args.concurrency
+
+
+def micro_benchmarks(args):
+    # (name, function) run back to back without the HTTP stack
+    from serialization import dump_json
+    from business.imaging import compress_image
+    from users.auth import get_bcrypt_context
+
+    contents = _png(random.Random(args.seed))
+
+    page = {'items': [{'product_id': i, 'name': f'product {i}', 'category': 'General',
+                       'price': Decimal('9.99'), 'discounted_price': None, 'discount': None,
+                       'product_images': [], 'date_published': datetime.datetime.now()}
+                      for i in range(50)], 'next_cursor': None}
+    yield 'micro compress_image [1024x768]', lambda: compress_image(contents)
+    yield 'micro bcrypt hash', lambda: get_bcrypt_context().hash(PASSWORD)
+    yield 'micro serialize 50 products', lambda: dump_json(page)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    # Nearest rank on sorted values
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))]
+
+
+def _summary(latencies: list[float], errors: int, elapsed: float) -> dict:
+    return {'requests': len(latencies), 'errors': errors,
+            'p50_ms': percentile(latencies, 0.50) * 1000, 'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000, 'rps': len(latencies) / elapsed,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+async def run_scenario(client, make_request, concurrency: int, args) -> dict:
+    latencies = []
+    errors = 0
+    for _ in range(args.warmup):
+        await client.request(**make_request())
+
+    pending = iter(range(args.requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in pending:
+            start = time.perf_counter()
+            response = await client.request(**make_request())
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return _summary(latencies, errors, time.perf_counter() - start)
+
+
+def run_micro(function, args) -> dict:
+    for _ in range(args.warmup):
+        function()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        call_start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - call_start)
+    return _summary(latencies, 0, time.perf_counter() - start)
+
+
+def compare(results: dict, baseline: dict, threshold: float, metrics: dict = COMPARED_METRICS) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for metric, direction in metrics.items():
+            change = (result[metric] - previous[metric]) / previous[metric] if previous[metric] else 0
+            if change * direction > threshold:
+                regressions.append(f'{name}: {metric} {previous[metric]:.1f} -> {result[metric]:.1f} '
+                                   f'({change:+.0%})')
+    return regressions
+
+
+def print_results(results: dict):
+    print(f"{'scenario':<48}{'reqs':>6}{'errs':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'rps':>9}{'rss MB':>8}")
+    for name, r in results.items():
+        print(f"{name:<48}{r['requests']:>6}{r['errors']:>6}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}"
+              f"{r['p99_ms']:>9.1f}{r['rps']:>9.1f}{r['peak_rss_mb']:>8.0f}")
+
+
+async def benchmark(args) -> dict:
+    import httpx
+    from main import app
+
+    results = {}
+    async with app.router.lifespan_context(app):
+        seeded = await seed(args)
+        print(f"Seeded {seeded['users']} users, {seeded['businesses']} businesses, "
+              f"{seeded['products']} products")
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            token = (await client.post('/user-api/token', data={
+                'username': 'bench0', 'password': PASSWORD})).json()['access_token']
+            for name, make_request, concurrency in scenarios(args, seeded, token):
+                if args.only and args.only not in name:
+                    continue
+                results[name] = await run_scenario(client, make_request, concurrency, args)
+    for name, function in micro_benchmarks(args):
+        if args.only and args.only not in name:
+            continue
+        results[name] = run_micro(function, args)
+    return results
+
+
+def main() -> int:
+    args = parse_args()
+    configure_environment(args)
+    results = asyncio.run(benchmark(args))
+    print_results(results)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Baseline saved to {args.save_baseline}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+        print(f'No regression beyond {args.threshold:.0%} of the baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
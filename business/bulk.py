@@ -0,0 +1,208 @@
+import io
+import csv
+import json
+import codecs
+from collections import deque
+from fastapi import Request, HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import insert, select
+from database import ReadSessionLocal
+from models import Product
+from serialization import dump_json
+from .schemas import CreateProduct
+from .search import index_products
+from .typeahead import track_products
+from .pagination import STREAM_BATCH_SIZE
+
+
+# Config
+BULK_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+CSV_TYPES = {'text/csv'}
+NDJSON_TYPES = {'application/x-ndjson', 'application/ndjson', 'application/jsonl'}
+EXPORT_FIELDS = ['product_id', 'name', 'category', 'price', 'discounted_price', 'discount',
+                 'offer_expiration_date', 'date_published']
+
+
+def body_format(request: Request) -> str:
+    content_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    if content_type in CSV_TYPES:
+        return 'csv'
+    if content_type in NDJSON_TYPES:
+        return 'ndjson'
+    raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                        detail='Send products as text/csv or application/x-ndjson')
+
+
+async def _text(request: Request):
+    # Decode the body as it arrives
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    try:
+        async for chunk in request.stream():
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail='Body must be UTF-8 encoded')
+
+
+async def _lines(request: Request):
+    # Only one partial line is ever buffered
+    buffer = ''
+    async for text in _text(request):
+        buffer += text
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            yield line.rstrip('\r')
+    if buffer:
+        yield buffer.rstrip('\r')
+
+
+class _CsvLines:
+    # What the one csv.reader of an import reads from. A quoted field may hold newlines, lines are
+    # let through once their record's quotes are balanced, so the reader only runs dry between records
+    def __init__(self):
+        self._ready = deque()
+        self._record = []
+        self._quotes = 0
+        self._partial = ''
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if not self._ready:
+            raise StopIteration
+        return self._ready.popleft()
+
+    def feed(self, text: str, final: bool = False):
+        *lines, self._partial = (self._partial + text).split('\n')
+        if final and self._partial:
+            lines.append(self._partial)
+            self._partial = ''
+        for line in lines:
+            self._record.append(line + '\n')
+            # Escaped quotes come in pairs, an odd count means a field is still open
+            self._quotes += line.count('"')
+            if self._quotes % 2 == 0:
+                self._ready.extend(self._record)
+                self._record = []
+                self._quotes = 0
+        if final:
+            self._ready.extend(self._record)
+            self._record = []
+
+
+def _parsed(reader):
+    try:
+        yield from reader
+    except csv.Error as e:
+        # Nothing is committed yet, the whole import is refused
+        raise HTTPException(status_code=400, detail=f'Malformed CSV at line {reader.line_num}: {e}')
+
+
+async def _csv_rows(request: Request):
+    lines = _CsvLines()
+    reader = csv.reader(lines)
+    async for text in _text(request):
+        lines.feed(text)
+        for values in _parsed(reader):
+            yield values
+    lines.feed('', final=True)
+    for values in _parsed(reader):
+        yield values
+
+
+async def _records(request: Request, body: str):
+    # Yields (row number, record), a record is None when the row can't be parsed
+    row_number = 0
+    if body == 'csv':
+        header = None
+        async for values in _csv_rows(request):
+            if not any(value.strip() for value in values):
+                continue
+            if header is None:
+                header = [name.strip() for name in values]
+                continue
+            row_number += 1
+            yield row_number, dict(zip(header, values))
+        return
+    async for line in _lines(request):
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield row_number, record if isinstance(record, dict) else None
+
+
+async def _insert_batch(db, batch: list[dict]) -> int:
+    # One executemany INSERT per batch, RETURNING gives the ids for the search index
+    product_ids = (await db.scalars(insert(Product).returning(Product.product_id), batch)).all()
+    await index_products(db, product_ids)
+    return len(product_ids)
+
+
+async def import_products(request: Request, business_id: int, db) -> dict:
+    body = body_format(request)
+    inserted = failed = 0
+    errors = []
+    batch = []
+    imported = []
+    async for row_number, record in _records(request, body):
+        try:
+            if record is None:
+                raise ValueError('Row is not a valid record')
+            # Empty CSV cells fall back to the schema defaults
+            values = {key: value for key, value in record.items() if value not in ('', None)}
+            product = CreateProduct.model_validate({**values, 'business_id': business_id})
+        except ValidationError as e:
+            row_errors = e.errors(include_url=False, include_context=False)
+        except ValueError as e:
+            row_errors = [{'msg': str(e)}]
+        else:
+            batch.append(product.model_dump())
+            imported.append((product.name, product.category))
+            if len(batch) >= BULK_BATCH_SIZE:
+                inserted += await _insert_batch(db, batch)
+                batch = []
+            continue
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({'row': row_number, 'errors': row_errors})
+    if batch:
+        inserted += await _insert_batch(db, batch)
+    await db.commit()
+    track_products(added=imported)
+    return {'inserted': inserted, 'failed': failed, 'errors': errors}
+
+
+async def _export_rows(business_id: int, body: str):
+    # Like the listing stream, the export owns its session for the lifetime of the cursor
+    async with ReadSessionLocal() as db:
+        result = await db.stream(
+            select(*(Product.__table__.c[field].label(field) for field in EXPORT_FIELDS))
+            .where(Product.business_id == business_id).order_by(Product.product_id)
+            .execution_options(yield_per=STREAM_BATCH_SIZE))
+        if body == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_FIELDS)
+            async for partition in result.partitions():
+                writer.writerows(jsonable_encoder([list(row) for row in partition]))
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+        else:
+            async for partition in result.mappings().partitions():
+                yield b''.join(dump_json(dict(row)) + b'\n' for row in partition)
+
+
+def export_products(business_id: int, body: str) -> StreamingResponse:
+    media_type = 'text/csv' if body == 'csv' else 'application/x-ndjson'
+    return StreamingResponse(_export_rows(business_id, body), media_type=media_type, headers={
+        'Content-Disposition': f'attachment; filename="business-{business_id}-products.{body}"'})
@@ -1,35 +1,76 @@
-from fastapi import APIRouter, UploadFile, HTTPException, status
+from fastapi import APIRouter, UploadFile, HTTPException, status, Query, Header
 from fastapi.responses import JSONResponse
-from typing import Annotated
-from database import db_dependency
-from models import Business, Product
-from .schemas import CreateBusiness, UpdateBusiness
-from users.auth import user_dependency
-from sqlalchemy import and_
-from .utils import save_and_compress_image
-import os
+from typing import Annotated, Literal
+from database import db_dependency, read_db_dependency
+from cache import cached_json, invalidate, BUSINESSES, PRODUCTS
+from models import Business, Product, User, read_columns
+from .schemas import (CreateBusiness, UpdateBusiness, ReadBusiness, Page, BusinessFacets, Suggestion,
+                      UNIQUE_BUSINESS_ERRORS)
+from users.auth import user_dependency, invalidate_user
+from users.validators import unique_constraints
+from sqlalchemy import and_, select, delete
+from .utils import save_and_compress_image, primary_image
+from .image_store import release_images, referenced_images
+from .pagination import paginate, stream_ndjson, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from .search import index_business_products, remove_products
+from .facets import business_facets
+from .typeahead import suggest, track_businesses, track_products, TYPEAHEAD_DEFAULT_LIMIT, TYPEAHEAD_MAX_LIMIT
 
 router = APIRouter(prefix='/business', tags=['business'])
+DEFAULT_LOGO = '/static/images/default.jpg'
 
 
-@router.get('/')
-async def get_all_or_some_businesses(db: db_dependency, business_owner: str | None = None,
-                                     city: str | None = None, region: str | None = None):
-    businesses = db.query(Business)
+def filter_businesses(business_owner: str | None = None, city: str | None = None,
+                      region: str | None = None):
+    businesses = select(*read_columns(Business, ReadBusiness))
     if business_owner:
-        businesses = businesses.filter(
-            Business.owner.has(username=business_owner))
+        # An uncorrelated lookup of the owner id, so the owner_id index is used
+        businesses = businesses.where(Business.owner_id == select(User.user_id).where(
+            User.username == business_owner).scalar_subquery())
     if city:
-        businesses = businesses.filter(Business.city == city)
+        businesses = businesses.where(Business.city == city)
     if region:
-        businesses = businesses.filter(Business.region == region)
-    return businesses.all()
-
-
-@router.get('/{business_id}')
-async def get_business(business_id: int, user: user_dependency, db: db_dependency):
-    business = db.query(Business).filter(and_(
-        Business.business_id == business_id, Business.owner_id == user['id'])).first()
+        businesses = businesses.where(Business.region == region)
+    return businesses
+
+
+@router.get('/', response_model=Page[ReadBusiness])
+async def get_all_or_some_businesses(db: read_db_dependency, business_owner: str | None = None,
+                                     city: str | None = None, region: str | None = None,
+                                     limit: Annotated[int, Query(gt=0, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+                                     cursor: str | None = None, stream: bool = False,
+                                     if_none_match: Annotated[str | None, Header()] = None):
+    businesses = filter_businesses(business_owner, city, region)
+    if stream:
+        return stream_ndjson(businesses, Business.business_id, cursor)
+    params = {'business_owner': business_owner, 'city': city, 'region': region,
+              'limit': limit, 'cursor': cursor}
+    return await cached_json(BUSINESSES, params,
+                             lambda: paginate(db, businesses, Business.business_id, cursor, limit), if_none_match)
+
+
+@router.get('/facets', response_model=BusinessFacets)
+async def get_business_facets(db: read_db_dependency, business_owner: str | None = None,
+                              city: str | None = None, region: str | None = None,
+                              if_none_match: Annotated[str | None, Header()] = None):
+    params = {'view': 'facets', 'business_owner': business_owner, 'city': city, 'region': region}
+    filtered = any(value is not None for value in (business_owner, city, region))
+    return await cached_json(BUSINESSES, params, lambda: business_facets(
+        db, filter_businesses(business_owner, city, region), filtered), if_none_match)
+
+
+@router.get('/suggest', response_model=list[Suggestion])
+async def suggest_locations(q: Annotated[str, Query(min_length=1, max_length=100)],
+                            field: Literal['city', 'region'] = 'city',
+                            limit: Annotated[int, Query(gt=0, le=TYPEAHEAD_MAX_LIMIT)] = TYPEAHEAD_DEFAULT_LIMIT):
+    # Typeahead from the in-memory prefix index, no database session is opened
+    return suggest(field, q, limit)
+
+
+@router.get('/{business_id}', response_model=ReadBusiness)
+async def get_business(business_id: int, user: user_dependency, db: read_db_dependency):
+    business = await db.scalar(select(Business).where(and_(
+        Business.business_id == business_id, Business.owner_id == user['id'])))
     if not business:
         raise HTTPException(status_code=404, detail=('Business not found!'))
     return business
@@ -37,9 +78,16 @@ async def get_business(business_id: int, user: user_dependency, db: db_dependenc
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
 async def create_business(business: CreateBusiness, user: user_dependency, db: db_dependency):
-    business = Business(**business.model_dump(), owner_id=user['id'])
-    db.add(business)
-    db.commit()
+    values = business.model_dump()
+    # The unique index on business_name does the duplicate check
+    business = Business(**values, owner_id=user['id'])
+    async with unique_constraints(db, UNIQUE_BUSINESS_ERRORS, values):
+        db.add(business)
+        await db.commit()
+    # Every cached token of the user loads its businesses again
+    invalidate_user(user['id'])
+    await invalidate(BUSINESSES)
+    track_businesses(added=[(business.city, business.region)])
 
 
 @router.put('/{business_id}/logo')
@@ -48,18 +96,23 @@ async def update_business_logo(logo: UploadFile, business_id: int, user: user_de
         business = await get_business(business_id=business_id, user=user, db=db)
 
         old_logo_path = business.logo
+        old_logo_variants = business.logo_variants
         # Save and compress the logo
         try:
-            file_path = await save_and_compress_image(logo)
-            business.logo = file_path
-            db.commit()
-
-            if old_logo_path and os.path.exists(old_logo_path) and old_logo_path != '/static/images/default.jpg':
-                os.remove(old_logo_path)
+            variants = await save_and_compress_image(logo, db)
+            business.logo = primary_image(variants)
+            business.logo_variants = variants
+            if old_logo_variants:
+                await release_images(db, [old_logo_variants])
+            elif old_logo_path and old_logo_path != DEFAULT_LOGO:
+                # A single file saved before variants existed
+                await release_images(db, [{'full': {'jpeg': old_logo_path}}])
+            await db.commit()
+            await invalidate(BUSINESSES)
 
             return {"message": "Business logo updated successfully"}
         except HTTPException as e:
-            return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail}, headers=e.headers)
     except HTTPException as e:
         raise HTTPException(status_code=e.status_code, detail=e.detail)
 
@@ -68,21 +121,43 @@ async def update_business_logo(logo: UploadFile, business_id: int, user: user_de
 async def update_business(updated_business: UpdateBusiness, business_id: int, user: user_dependency, db: db_dependency):
     try:
         business = await get_business(business_id=business_id, user=user, db=db)
-        for key, value in updated_business.model_dump().items():
+        previous = (business.city, business.region)
+        values = updated_business.model_dump()
+        for key, value in values.items():
             if value:
                 setattr(business, key, value)
             elif key == 'business_description':
                 setattr(business, key, None)
-        db.commit()
+        async with unique_constraints(db, UNIQUE_BUSINESS_ERRORS, values):
+            if updated_business.business_name:
+                # Product search documents carry the business name
+                await db.flush()
+                await index_business_products(db, business_id)
+            await db.commit()
+            await invalidate(BUSINESSES)
+        if (business.city, business.region) != previous:
+            track_businesses(added=[(business.city, business.region)], removed=[previous])
     except HTTPException as e:
         raise HTTPException(status_code=e.status_code, detail=e.detail)
 
 
 @router.delete('/')
 async def delete_business(business_id: int, user: user_dependency, db: db_dependency):
-    business_query = db.query(Business).filter(and_(
-        Business.business_id == business_id, Business.owner_id == user['id']))
-    if not business_query:
+    business = (await db.execute(select(Business.city, Business.region, Business.logo_variants).where(and_(
+        Business.business_id == business_id, Business.owner_id == user['id'])))).first()
+    if business is None:
         raise HTTPException(status_code=404, detail=('Business not found!'))
-    business_query.delete()
-    db.commit()
+    # The products go with the business, their images and the logo lose a reference
+    products = (await db.execute(select(
+        Product.product_id, Product.name, Product.category, Product.product_images, Product.product_image_variants
+    ).where(Product.business_id == business_id))).all()
+    await release_images(db, [variants for product in products for variants in referenced_images(product)]
+                         + ([business.logo_variants] if business.logo_variants else []))
+    await db.execute(delete(Product).where(Product.business_id == business_id))
+    await remove_products(db, [product.product_id for product in products])
+    await db.execute(delete(Business).where(Business.business_id == business_id))
+    await db.commit()
+    invalidate_user(user['id'])
+    await invalidate(BUSINESSES, PRODUCTS)
+    track_businesses(removed=[(business.city, business.region)])
+    track_products(removed=[(product.name, product.category) for product in products])
@@ -0,0 +1,44 @@
+from sqlalchemy import update, func
+from models import Product
+from .schemas import CampaignFilter, CreateCampaign
+
+
+def campaign_filter(campaign: CampaignFilter) -> list:
+    conditions = [Product.business_id == campaign.business_id]
+    if campaign.category:
+        conditions.append(Product.category == campaign.category)
+    # Campaigns go by the regular price, not by what an earlier offer brought it down to
+    if campaign.price_le is not None:
+        conditions.append(Product.price <= campaign.price_le)
+    if campaign.price_ge is not None:
+        conditions.append(Product.price >= campaign.price_ge)
+    return conditions
+
+
+async def apply_campaign(db, campaign: CreateCampaign) -> int:
+    # One UPDATE for every matching product, the same discount the model setter derives is
+    # computed in SQL. Replaces any offer the products already had
+    conditions = campaign_filter(campaign) + [Product.price > 0]
+    if campaign.percent_off is not None:
+        discounted_price = func.round(Product.price * (100 - campaign.percent_off) / 100, 2)
+        discount = campaign.percent_off
+    else:
+        # A fixed amount can't take a product to zero or below, those are left out
+        conditions.append(Product.price > campaign.amount_off)
+        discounted_price = Product.price - campaign.amount_off
+        discount = func.round(campaign.amount_off * 100 / Product.price, 2)
+    result = await db.execute(update(Product).where(*conditions).values(
+        _discounted_price=discounted_price, discount=discount,
+        offer_expiration_date=campaign.offer_expiration_date
+    ).execution_options(synchronize_session=False))
+    return result.rowcount
+
+
+async def end_campaign(db, campaign: CampaignFilter) -> int:
+    # Same clearing the offer sweeper does at expiry, ahead of time
+    result = await db.execute(update(Product).where(
+        *campaign_filter(campaign), Product._discounted_price.is_not(None)
+    ).values(
+        offer_expiration_date=None, discount=None, _discounted_price=None
+    ).execution_options(synchronize_session=False))
+    return result.rowcount
@@ -0,0 +1,155 @@
+from sqlalchemy import text, select, func, case, literal
+from models import CatalogFacet
+
+
+# Config
+FACET_TABLE = 'catalog_facets'
+# Lower bounds of the price histogram buckets, the last one is open ended
+PRICE_BUCKETS = [0, 10, 25, 50, 100, 250, 500, 1000]
+PRODUCT_FACETS = ('category', 'price')
+BUSINESS_FACETS = ('city', 'region')
+
+
+def bucket_labels() -> list[str]:
+    return [f'{low}-{high}' for low, high in zip(PRICE_BUCKETS, PRICE_BUCKETS[1:])] + [f'{PRICE_BUCKETS[-1]}+']
+
+
+def price_bucket(column):
+    # Same buckets as _bucket_sql, for GROUP BY over a filtered listing
+    labels = bucket_labels()
+    return case(*((column < high, literal(label)) for high, label in zip(PRICE_BUCKETS[1:], labels)),
+                else_=literal(labels[-1]))
+
+
+def _bucket_sql(column: str) -> str:
+    labels = bucket_labels()
+    whens = ' '.join(f"WHEN {column} < {high} THEN '{label}'" for high, label in zip(PRICE_BUCKETS[1:], labels))
+    return f"CASE {whens} ELSE '{labels[-1]}' END"
+
+
+def _product_deltas(row: str, sign: int) -> list[tuple[str, str, int]]:
+    return [('category', f'{row}.category', sign), ('price', _bucket_sql(f'{row}.effective_price'), sign)]
+
+
+def _business_deltas(row: str, sign: int) -> list[tuple[str, str, int]]:
+    return [('city', f'{row}.city', sign), ('region', f'{row}.region', sign)]
+
+
+# Every write path (ORM, bulk inserts, set-based updates) goes through these triggers,
+# one upsert per delta so an unchanged value is decremented and incremented in turn
+_UPSERT = f"""
+    INSERT INTO {FACET_TABLE}(facet, value, count) VALUES ('{{facet}}', {{value}}, {{delta}})
+    ON CONFLICT (facet, value) DO UPDATE SET count = {FACET_TABLE}.count + excluded.count;
+"""
+# table -> (deltas for a row, columns an update has to touch to change a facet)
+_SOURCES = {'products': (_product_deltas, 'category, price, discounted_price'),
+            'businesses': (_business_deltas, 'city, region')}
+
+
+def _upserts(deltas) -> str:
+    return ''.join(_UPSERT.format(facet=facet, value=value, delta=delta) for facet, value, delta in deltas)
+
+
+def _sqlite_ddl() -> list[str]:
+    statements = []
+    for table, (deltas, columns) in _SOURCES.items():
+        statements += [
+            f"CREATE TRIGGER IF NOT EXISTS {table}_facets_insert AFTER INSERT ON {table} BEGIN"
+            f"{_upserts(deltas('NEW', 1))} END",
+            f"CREATE TRIGGER IF NOT EXISTS {table}_facets_update AFTER UPDATE OF {columns} ON {table} BEGIN"
+            f"{_upserts(deltas('OLD', -1) + deltas('NEW', 1))} END",
+            f"CREATE TRIGGER IF NOT EXISTS {table}_facets_delete AFTER DELETE ON {table} BEGIN"
+            f"{_upserts(deltas('OLD', -1))} END",
+        ]
+    return statements
+
+
+def _pg_ddl() -> list[str]:
+    statements = []
+    for table, (deltas, columns) in _SOURCES.items():
+        statements += [
+            f"""CREATE OR REPLACE FUNCTION {table}_facets() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN {_upserts(deltas('OLD', -1))} END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN {_upserts(deltas('NEW', 1))} END IF;
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql""",
+            f"DROP TRIGGER IF EXISTS {table}_facets ON {table}",
+            f"""CREATE TRIGGER {table}_facets AFTER INSERT OR DELETE OR UPDATE OF {columns} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_facets()""",
+        ]
+    return statements
+
+
+_BACKFILL = [
+    f"""INSERT INTO {FACET_TABLE}(facet, value, count)
+        SELECT 'category', category, COUNT(*) FROM products GROUP BY category""",
+    f"""INSERT INTO {FACET_TABLE}(facet, value, count)
+        SELECT 'price', bucket, COUNT(*) FROM (SELECT {_bucket_sql('effective_price')} AS bucket
+        FROM products) AS buckets GROUP BY bucket""",
+    f"INSERT INTO {FACET_TABLE}(facet, value, count) SELECT 'city', city, COUNT(*) FROM businesses GROUP BY city",
+    f"""INSERT INTO {FACET_TABLE}(facet, value, count)
+        SELECT 'region', region, COUNT(*) FROM businesses GROUP BY region""",
+]
+
+
+def create_facet_triggers(conn):
+    # Takes a sync connection, it runs from a migration
+    conn.execute(text(f'DELETE FROM {FACET_TABLE}'))
+    for statement in _BACKFILL:
+        conn.execute(text(statement))
+    for statement in (_pg_ddl() if conn.dialect.name == 'postgresql' else _sqlite_ddl()):
+        conn.execute(text(statement))
+
+
+def drop_facet_triggers(conn):
+    for table in _SOURCES:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text(f'DROP TRIGGER IF EXISTS {table}_facets ON {table}'))
+            conn.execute(text(f'DROP FUNCTION IF EXISTS {table}_facets()'))
+        else:
+            for event in ('insert', 'update', 'delete'):
+                conn.execute(text(f'DROP TRIGGER IF EXISTS {table}_facets_{event}'))
+
+
+async def summary_facets(db, facets: tuple[str, ...]) -> dict:
+    # Unfiltered counts are read from the summary table, no scan of the catalog
+    rows = (await db.execute(select(CatalogFacet.facet, CatalogFacet.value, CatalogFacet.count).where(
+        CatalogFacet.facet.in_(facets), CatalogFacet.count > 0))).all()
+    counts = {facet: {} for facet in facets}
+    for facet, value, count in rows:
+        counts[facet][value] = count
+    return counts
+
+
+async def grouped_counts(db, column) -> dict:
+    # `column` belongs to a filtered listing subquery
+    rows = (await db.execute(select(column, func.count()).group_by(column))).all()
+    return {value: count for value, count in rows}
+
+
+def _ordered(counts: dict, facet: str) -> dict:
+    # Histogram buckets keep their order and show empty buckets, values go by count
+    if facet == 'price':
+        return {label: counts.get(label, 0) for label in bucket_labels()}
+    return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+
+async def product_facets(db, products, filtered: bool) -> dict:
+    if not filtered:
+        counts = await summary_facets(db, PRODUCT_FACETS)
+    else:
+        listing = products.subquery()
+        counts = {'category': await grouped_counts(db, listing.c.category),
+                  'price': await grouped_counts(db, price_bucket(listing.c.effective_price))}
+    return {facet: _ordered(counts[facet], facet) for facet in PRODUCT_FACETS}
+
+
+async def business_facets(db, businesses, filtered: bool) -> dict:
+    if not filtered:
+        counts = await summary_facets(db, BUSINESS_FACETS)
+    else:
+        listing = businesses.subquery()
+        counts = {'city': await grouped_counts(db, listing.c.city),
+                  'region': await grouped_counts(db, listing.c.region)}
+    return {facet: _ordered(counts[facet], facet) for facet in BUSINESS_FACETS}
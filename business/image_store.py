@@ -0,0 +1,153 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+import datetime
+from collections import Counter
+from sqlalchemy import select, update, delete, case
+from database import SessionLocal, engine
+from models import StoredImage
+from storage import storage
+
+
+# Config
+IMAGE_GC_INTERVAL = int(os.getenv('IMAGE_GC_INTERVAL', 300))  # seconds
+# Seconds an unreferenced image is kept, so an upload that is about to reuse it never loses it
+IMAGE_GC_GRACE = int(os.getenv('IMAGE_GC_GRACE', 3600))
+IMAGE_GC_BATCH_SIZE = 500
+_HASH = re.compile('[0-9a-f]{64}')
+
+logger = logging.getLogger(__name__)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def image_hash(variants: dict) -> str | None:
+    # Stored file names start with the content hash, images saved before the store have a UUID
+    name = os.path.basename(variants['full']['jpeg'])
+    candidate = name.split('_')[0]
+    return candidate if _HASH.fullmatch(candidate) else None
+
+
+def _insert():
+    # Only the dialect in use is imported, the Postgres one alone is a sizeable import
+    if engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(StoredImage)
+
+
+async def register_images(images: dict[str, dict]) -> dict[str, dict]:
+    # Committed on its own session before anything is written: a new row starts out orphaned,
+    # an existing orphan gets a fresh grace period. Returns the keys of images already stored
+    now = _now()
+    async with SessionLocal() as db:
+        insert = _insert()
+        rows = (await db.execute(insert.values([
+            {'image_hash': image_hash, 'variants': keys, 'refcount': 0, 'orphaned_at': now}
+            for image_hash, keys in images.items()
+        ]).on_conflict_do_update(index_elements=[StoredImage.image_hash], set_={
+            'orphaned_at': case((StoredImage.refcount <= 0, now), else_=StoredImage.orphaned_at)
+        }).returning(StoredImage.image_hash, StoredImage.variants, StoredImage.stored_at))).all()
+        await db.commit()
+    return {image_hash: keys for image_hash, keys, stored_at in rows if stored_at is not None}
+
+
+async def mark_stored(image_hashes: list[str]):
+    async with SessionLocal() as db:
+        await db.execute(update(StoredImage).where(StoredImage.image_hash.in_(image_hashes)).values(
+            stored_at=_now()))
+        await db.commit()
+
+
+async def _adjust(db, image_hashes: Counter, sign: int):
+    # One UPDATE per distinct count, the same image can be referenced several times at once
+    by_count: dict[int, list[str]] = {}
+    for image_hash, count in image_hashes.items():
+        by_count.setdefault(count, []).append(image_hash)
+    now = _now()
+    for count, hashes in by_count.items():
+        refcount = StoredImage.refcount + sign * count
+        await db.execute(update(StoredImage).where(StoredImage.image_hash.in_(hashes)).values(
+            refcount=refcount, orphaned_at=case((refcount <= 0, now), else_=None)
+        ).execution_options(synchronize_session=False))
+
+
+async def acquire_images(db, image_hashes: list[str]):
+    # Part of the caller's transaction, like the product or business row that now holds them
+    await _adjust(db, Counter(image_hashes), 1)
+
+
+def referenced_images(product) -> list[dict]:
+    # Every `product_images` entry holds a reference, the same upload can appear twice
+    variants = product.product_image_variants or {}
+    return [variants[path] for path in product.product_images or [] if path in variants]
+
+
+def _legacy_row(variants: dict, now: datetime.datetime) -> dict:
+    # Saved before the store, nothing else shares these files. Keyed on a hash of the path, and
+    # orphaned past the grace period since no upload can reuse them
+    keys = {variant: {image_format: storage.key(path) for image_format, path in formats.items()
+                      if storage.key(path)}
+            for variant, formats in variants.items()}
+    return {'image_hash': hashlib.sha256(variants['full']['jpeg'].encode()).hexdigest(), 'variants': keys,
+            'refcount': 0, 'stored_at': now, 'orphaned_at': now - datetime.timedelta(seconds=IMAGE_GC_GRACE)}
+
+
+async def release_images(db, variants_list: list[dict]):
+    # Part of the caller's transaction. Files go only through the collector, once the rows
+    # releasing them are committed
+    hashes = Counter()
+    legacy = {}
+    now = _now()
+    for variants in variants_list:
+        image = image_hash(variants)
+        if image:
+            hashes[image] += 1
+        else:
+            row = _legacy_row(variants, now)
+            legacy[row['image_hash']] = row
+    if legacy:
+        await db.execute(_insert().values(list(legacy.values())).on_conflict_do_nothing())
+    await _adjust(db, hashes, -1)
+
+
+def _orphaned(cutoff: datetime.datetime) -> tuple:
+    return StoredImage.orphaned_at <= cutoff, StoredImage.refcount <= 0
+
+
+def orphaned_images_query(cutoff: datetime.datetime):
+    return select(StoredImage.image_hash).where(*_orphaned(cutoff)).limit(IMAGE_GC_BATCH_SIZE)
+
+
+async def collect_orphaned_images(db) -> int:
+    # The rows go first, in batches, so an upload can't revive an image while its files are deleted
+    collected = 0
+    while True:
+        cutoff = _now() - datetime.timedelta(seconds=IMAGE_GC_GRACE)
+        rows = (await db.scalars(delete(StoredImage).where(
+            StoredImage.image_hash.in_(orphaned_images_query(cutoff)), *_orphaned(cutoff)
+        ).returning(StoredImage.variants).execution_options(synchronize_session=False))).all()
+        await db.commit()
+        if not rows:
+            break
+        await storage.delete([key for variants in rows for formats in variants.values()
+                              for key in formats.values()])
+        collected += len(rows)
+    return collected
+
+
+async def run_image_collector():
+    while True:
+        try:
+            async with SessionLocal() as db:
+                collected = await collect_orphaned_images(db)
+            if collected:
+                logger.info('Removed %s unreferenced images', collected)
+        except Exception:
+            logger.exception('Image garbage collection failed')
+        await asyncio.sleep(IMAGE_GC_INTERVAL)
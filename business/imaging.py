@@ -0,0 +1,55 @@
+import os
+from io import BytesIO
+
+# Config
+# Leading bytes of every accepted file -> Pillow format
+IMAGE_SIGNATURES = {b'\xff\xd8\xff': 'JPEG', b'\x89PNG\r\n\x1a\n': 'PNG',
+                    b'GIF87a': 'GIF', b'GIF89a': 'GIF'}
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 40_000_000))
+# Longest side in pixels for every variant, None keeps the original size
+IMAGE_VARIANTS = {'thumb': 200, 'medium': 800, 'full': None}
+# Format key -> (Pillow format, file extension, save options)
+IMAGE_FORMATS = {'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+                 'jpeg': ('JPEG', 'jpg', {'quality': 85, 'optimize': True, 'progressive': True})}
+
+
+def sniff_image_format(header: bytes) -> str | None:
+    for signature, image_format in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return image_format
+    return None
+
+
+def compress_image(contents: bytes) -> dict:
+    # Runs in a worker process, which imports only this module. Pillow is loaded on
+    # the first image so a process that never handles one doesn't pay for it
+    from PIL import Image, UnidentifiedImageError
+
+    # Pillow refuses anything far beyond the limit on open, the check below does the rest
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    img = Image.open(BytesIO(contents))
+    # Only the header has been parsed so far, nothing is decoded yet
+    if img.format not in IMAGE_SIGNATURES.values():
+        raise UnidentifiedImageError(f'Unsupported image format {img.format}')
+    if img.width * img.height > MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(
+            f'Image size ({img.width * img.height} pixels) exceeds limit')
+    img.verify()
+
+    # verify() leaves the image unusable, it has to be opened again to decode it
+    img = Image.open(BytesIO(contents))
+    img = img.convert("RGB")  # Ensure compatibility with all formats
+
+    variants = {}
+    for variant, size in IMAGE_VARIANTS.items():
+        resized = img
+        if size and max(img.size) > size:
+            resized = img.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+        variants[variant] = {}
+        for image_format, (pillow_format, _, options) in IMAGE_FORMATS.items():
+            # Encoded here, the backend writes them from the event loop
+            buffer = BytesIO()
+            resized.save(buffer, format=pillow_format, **options)
+            variants[variant][image_format] = buffer.getvalue()
+    return variants
@@ -0,0 +1,50 @@
+import os
+import asyncio
+import logging
+import datetime
+from sqlalchemy import select, update
+from database import SessionLocal
+from models import Product
+from cache import invalidate, PRODUCTS
+
+
+# Config
+OFFER_SWEEP_INTERVAL = int(os.getenv('OFFER_SWEEP_INTERVAL', 60))  # seconds
+OFFER_SWEEP_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def expired_offers_query(now: datetime.datetime):
+    return select(Product.product_id).where(
+        Product.offer_expiration_date <= now).limit(OFFER_SWEEP_BATCH_SIZE)
+
+
+async def sweep_expired_offers(db) -> int:
+    # Cleared in id batches so a large expiry never holds the write lock for long
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cleared = 0
+    while True:
+        product_ids = (await db.scalars(expired_offers_query(now))).all()
+        if not product_ids:
+            break
+        await db.execute(update(Product).where(Product.product_id.in_(product_ids)).values(
+            offer_expiration_date=None, discount=None, _discounted_price=None
+        ).execution_options(synchronize_session=False))
+        await db.commit()
+        cleared += len(product_ids)
+    if cleared:
+        await invalidate(PRODUCTS)
+    return cleared
+
+
+async def run_offer_sweeper():
+    while True:
+        try:
+            async with SessionLocal() as db:
+                cleared = await sweep_expired_offers(db)
+            if cleared:
+                logger.info('Cleared %s expired offers', cleared)
+        except Exception:
+            logger.exception('Expired offer sweep failed')
+        await asyncio.sleep(OFFER_SWEEP_INTERVAL)
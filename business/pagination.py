@@ -0,0 +1,84 @@
+import base64
+import json
+from fastapi import HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Select, tuple_
+from database import ReadSessionLocal
+from serialization import dump_json
+
+
+# Config
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+STREAM_BATCH_SIZE = 500
+
+
+def invalid_cursor() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+
+
+def encode_cursor(after: int | float | list) -> str:
+    payload = json.dumps({'after': after}).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))['after']
+    except (ValueError, KeyError, TypeError):
+        raise invalid_cursor()
+
+
+def decode_offset(cursor: str | None) -> int:
+    offset = decode_cursor(cursor) if cursor else 0
+    if not isinstance(offset, int) or offset < 0:
+        raise invalid_cursor()
+    return offset
+
+
+def _columns(key) -> tuple:
+    # A key is one column or a tuple of columns ending with a unique one
+    return key if isinstance(key, tuple) else (key,)
+
+
+def after_cursor(query: Select, key, cursor: str | None, descending: bool = False) -> Select:
+    columns = _columns(key)
+    if cursor:
+        after = decode_cursor(cursor)
+        values = after if isinstance(after, list) else [after]
+        if len(values) != len(columns) or not all(isinstance(value, (int, float)) for value in values):
+            raise invalid_cursor()
+        if len(columns) > 1:
+            row, bound = tuple_(*columns), tuple_(*values)
+        else:
+            row, bound = columns[0], values[0]
+        query = query.where(row < bound if descending else row > bound)
+    return query.order_by(*(column.desc() if descending else column for column in columns))
+
+
+async def paginate(db, query: Select, key, cursor: str | None, limit: int,
+                   descending: bool = False) -> dict:
+    # Fetch one extra row to know if there is a next page. Queries select plain columns,
+    # rows come back as dicts without building ORM objects
+    rows = (await db.execute(after_cursor(query, key, cursor, descending).limit(limit + 1))).mappings().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = jsonable_encoder([rows[-1][column.key] for column in _columns(key)])
+        next_cursor = encode_cursor(last if len(last) > 1 else last[0])
+    return {'items': [dict(row) for row in rows], 'next_cursor': next_cursor}
+
+
+async def _iter_ndjson(query: Select):
+    # The request session is released before the body is streamed,
+    # so the stream owns its own session for the lifetime of the cursor.
+    async with ReadSessionLocal() as db:
+        result = await db.stream(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+        async for partition in result.mappings().partitions():
+            yield b''.join(dump_json(dict(row)) + b'\n' for row in partition)
+
+
+def stream_ndjson(query: Select, key, cursor: str | None, descending: bool = False) -> StreamingResponse:
+    return StreamingResponse(_iter_ndjson(after_cursor(query, key, cursor, descending)),
+                             media_type='application/x-ndjson')
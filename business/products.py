@@ -1,72 +1,187 @@
-from fastapi import APIRouter, HTTPException, status, Path, UploadFile, Body
-from .schemas import CreateProduct, UpdateProduct, ReadProduct
-from database import db_dependency
-from models import Product, Business
-from users.auth import user_dependency
-from typing import Annotated
-from .utils import save_and_compress_image
-import os
-import datetime
+from fastapi import APIRouter, HTTPException, status, Path, UploadFile, Body, Query, Request, Header
+from .schemas import (CreateProduct, UpdateProduct, ReadProduct, Page, ProductFacets, CampaignFilter, CreateCampaign,
+                      Suggestion)
+from database import db_dependency, read_db_dependency
+from cache import cached_json, invalidate, tagged_json, PRODUCTS
+from models import Product, read_columns
+from serialization import dump_json
+from users.auth import user_dependency, owns_business
+from typing import Annotated, Literal
+from .utils import save_and_compress_images, primary_image
+from .image_store import release_images, referenced_images
+from .pagination import paginate, stream_ndjson, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from .search import index_products, remove_products, matching_product_ids, search_products
+from .bulk import import_products, export_products
+from .facets import product_facets
+from .campaigns import apply_campaign, end_campaign
+from .typeahead import suggest, track_products, TYPEAHEAD_DEFAULT_LIMIT, TYPEAHEAD_MAX_LIMIT
+from sqlalchemy import select, delete
 
 
 router = APIRouter(prefix='/product', tags=['product'])
 
+# sort param -> (keyset columns, descending)
+PRODUCT_SORTS = {'id': (Product.product_id, False),
+                 'price': ((Product.effective_price, Product.product_id), False),
+                 '-price': ((Product.effective_price, Product.product_id), True)}
 
-@router.get('/')
-async def get_all_or_some_product(db: db_dependency, name: str | None = None, category: str | None = None,
-                                  price_le: int | None = None, price_ge: int | None = None):
-    products = db.query(Product)
+
+def filter_products(name: str | None = None, category: str | None = None,
+                    price_le: int | None = None, price_ge: int | None = None):
+    products = select(*read_columns(Product, ReadProduct))
     if category:
-        products = products.filter(Product.category == category)
+        products = products.where(Product.category == category)
     if name:
-        products = products.filter(Product.name.ilike(f"%{name}%"))
-    if price_le:
-        products = products.filter(Product.price <= price_le)
-    if price_ge:
-        products = products.filter(Product.price >= price_ge)
-    return products.all()
+        matches = matching_product_ids(name)
+        if matches is not None:
+            products = products.where(Product.product_id.in_(matches))
+        else:
+            products = products.where(Product.name.ilike(f"%{name}%"))
+    # Price filters look at what the product sells for now, offers included
+    if price_le is not None:
+        products = products.where(Product.effective_price <= price_le)
+    if price_ge is not None:
+        products = products.where(Product.effective_price >= price_ge)
+    return products
 
 
-@router.get('/{product_id}', response_model=ReadProduct)
-async def get_product(product_id: int, user: user_dependency, db: db_dependency):
-    product = db.query(Product).filter(Product.product_id == product_id).filter(
-        Product.business.has(Business.owner_id == user['id'])).first()
-    if not product:
+@router.get('/', response_model=Page[ReadProduct])
+async def get_all_or_some_product(db: read_db_dependency, name: str | None = None, category: str | None = None,
+                                  price_le: int | None = None, price_ge: int | None = None,
+                                  limit: Annotated[int, Query(gt=0, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+                                  cursor: str | None = None, stream: bool = False,
+                                  sort: Literal['id', 'price', '-price'] = 'id',
+                                  if_none_match: Annotated[str | None, Header()] = None):
+    products = filter_products(name, category, price_le, price_ge)
+    key, descending = PRODUCT_SORTS[sort]
+    if stream:
+        return stream_ndjson(products, key, cursor, descending)
+    params = {'name': name, 'category': category, 'price_le': price_le, 'price_ge': price_ge,
+              'limit': limit, 'cursor': cursor, 'sort': sort}
+    return await cached_json(PRODUCTS, params,
+                             lambda: paginate(db, products, key, cursor, limit, descending), if_none_match)
+
+
+@router.get('/facets', response_model=ProductFacets)
+async def get_product_facets(db: read_db_dependency, name: str | None = None, category: str | None = None,
+                             price_le: int | None = None, price_ge: int | None = None,
+                             if_none_match: Annotated[str | None, Header()] = None):
+    # Category counts and a price histogram for the same filters as the listing
+    params = {'view': 'facets', 'name': name, 'category': category, 'price_le': price_le, 'price_ge': price_ge}
+    filtered = any(value is not None for value in (name, category, price_le, price_ge))
+    return await cached_json(PRODUCTS, params, lambda: product_facets(
+        db, filter_products(name, category, price_le, price_ge), filtered), if_none_match)
+
+
+@router.get('/search', response_model=Page[ReadProduct])
+async def search(db: read_db_dependency, q: Annotated[str, Query(min_length=1, max_length=200)],
+                 limit: Annotated[int, Query(gt=0, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+                 cursor: str | None = None):
+    return await search_products(db, q, cursor, limit)
+
+
+@router.get('/suggest', response_model=list[Suggestion])
+async def suggest_products(q: Annotated[str, Query(min_length=1, max_length=100)],
+                           field: Literal['name', 'category'] = 'name',
+                           limit: Annotated[int, Query(gt=0, le=TYPEAHEAD_MAX_LIMIT)] = TYPEAHEAD_DEFAULT_LIMIT):
+    # Typeahead from the in-memory prefix index, no database session is opened
+    return suggest(field, q, limit)
+
+
+@router.get('/export')
+async def bulk_export_products(business_id: int, user: user_dependency, db: read_db_dependency,
+                               export_format: Annotated[Literal['csv', 'ndjson'], Query(alias='format')] = 'csv'):
+    if not await owns_business(user, business_id, db):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=(
+            "Couldn't find the business"))
+    return export_products(business_id, export_format)
+
+
+async def get_product(product_id: int, user: dict, db, write: bool = False):
+    product = await db.scalar(select(Product).where(Product.product_id == product_id))
+    # Reads take ownership from the principal's business ids, no join to businesses
+    if not product or not await owns_business(user, product.business_id, db, write):
         raise HTTPException(status_code=404, detail=('Product not found!'))
-    # add timezone in production
-    # if product.offer_expiration_date and product.offer_expiration_date < datetime.datetime.now():
-    #     product.offer_expiration_date = None
-    #     product.discounted_price = None
-    #     product.discount = None
-    #     db.commit()
+    # Expired offers are cleared by the background sweeper in offers.py, reads stay read-only
     return product
 
 
+@router.get('/{product_id}', response_model=ReadProduct)
+async def read_product(product_id: int, user: user_dependency, db: read_db_dependency,
+                       if_none_match: Annotated[str | None, Header()] = None):
+    # Tagged once the product is loaded and owned, so even `If-None-Match: *` can't skip the check
+    product = await get_product(product_id, user, db)
+    return tagged_json(dump_json(ReadProduct.model_validate(product, from_attributes=True).model_dump()),
+                       if_none_match)
+
+
 @router.post('/', status_code=status.HTTP_201_CREATED)
 async def create_product(product: CreateProduct, user: user_dependency, db: db_dependency):
-    business = db.query(Business).filter(
-        Business.business_id == product.business_id).filter(Business.owner_id == user['id']).first()
-    if not business:
+    if not await owns_business(user, product.business_id, db, write=True):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=(
             "Couldn't find the business"))
 
     product = Product(**product.model_dump())
     db.add(product)
-    db.commit()
+    await db.flush()
+    await index_products(db, [product.product_id])
+    await db.commit()
+    await invalidate(PRODUCTS)
+    track_products(added=[(product.name, product.category)])
+
+
+@router.post('/bulk', status_code=status.HTTP_201_CREATED)
+async def bulk_import_products(business_id: int, request: Request, user: user_dependency, db: db_dependency):
+    # The body is a CSV (with a header row) or NDJSON stream of CreateProduct records
+    if not await owns_business(user, business_id, db, write=True):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=(
+            "Couldn't find the business"))
+    report = await import_products(request, business_id, db)
+    await invalidate(PRODUCTS)
+    return report
+
+
+@router.post('/campaigns')
+async def create_campaign(campaign: CreateCampaign, user: user_dependency, db: db_dependency):
+    # A percentage or fixed discount on every matching product, in one statement
+    if not await owns_business(user, campaign.business_id, db, write=True):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=(
+            "Couldn't find the business"))
+    updated = await apply_campaign(db, campaign)
+    await db.commit()
+    await invalidate(PRODUCTS)
+    return {'updated': updated}
+
+
+@router.delete('/campaigns')
+async def delete_campaign(campaign: Annotated[CampaignFilter, Body()], user: user_dependency, db: db_dependency):
+    if not await owns_business(user, campaign.business_id, db, write=True):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=(
+            "Couldn't find the business"))
+    reverted = await end_campaign(db, campaign)
+    await db.commit()
+    await invalidate(PRODUCTS)
+    return {'reverted': reverted}
 
 
 @router.put('/{product_id}', status_code=status.HTTP_204_NO_CONTENT)
 async def update_product(product_id: Annotated[int, Path(gt=0)], updated_product: UpdateProduct,
                          user: user_dependency, db: db_dependency):
     try:
-        product = await get_product(product_id, user, db)
+        product = await get_product(product_id, user, db, write=True)
+        previous = (product.name, product.category)
         for key, value in updated_product.model_dump().items():
             if value:
                 setattr(product, key, value)
         # if product.discounted_price:
         #     product.discount = (product.price - product.discounted_price) / \
         #         product.price * 100 if product.price != 0 else 0
-        db.commit()
+        await db.flush()
+        await index_products(db, [product.product_id])
+        await db.commit()
+        await invalidate(PRODUCTS)
+        if (product.name, product.category) != previous:
+            track_products(added=[(product.name, product.category)], removed=[previous])
     except HTTPException as e:
         raise HTTPException(status_code=e.status_code, detail=e.detail)
 
@@ -75,31 +190,31 @@ async def update_product(product_id: Annotated[int, Path(gt=0)], updated_product
 async def add_product_images(product_id: Annotated[int, Path(gt=0)], images: list[UploadFile],
                              user: user_dependency, db: db_dependency):
     try:
-        product = await get_product(product_id, user, db)
+        product = await get_product(product_id, user, db, write=True)
 
         # Collect existing images
         all_images = product.product_images.copy() if product.product_images else []
-        added_images = []
+        all_variants = dict(product.product_image_variants or {})
 
-        for image in images:
-            try:
-                file_path = await save_and_compress_image(image)
-                added_images.append(file_path)
-            except HTTPException as e:
-                # Clean up any images that were successfully saved before the error
-                for path in added_images:
-                    os.remove(path)
-                raise HTTPException(status_code=e.status_code, detail=f"{
-                                    e.detail}, no images added")
+        try:
+            # Images are compressed in parallel, a failure removes the ones already saved
+            added_images = await save_and_compress_images(images, db)
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"{e.detail}, no images added",
+                                headers=e.headers)
 
         # Update product images if new images were successfully added
         if added_images:
-            all_images.extend(added_images)
+            for variants in added_images:
+                all_images.append(primary_image(variants))
+                all_variants[primary_image(variants)] = variants
             product.product_images = all_images
-            db.commit()
+            product.product_image_variants = all_variants
+            await db.commit()
+            await invalidate(PRODUCTS)
 
     except HTTPException as e:
-        raise HTTPException(status_code=e.status_code, detail=e.detail)
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
     except Exception as e:
         # Handle unexpected exceptions
         raise HTTPException(
@@ -110,17 +225,26 @@ async def add_product_images(product_id: Annotated[int, Path(gt=0)], images: lis
 async def delete_product_images(product_id: Annotated[int, Path(gt=0)], images_path: Annotated[list[str], Body()],
                                 user: user_dependency, db: db_dependency):
     try:
-        product = await get_product(product_id, user, db)
+        product = await get_product(product_id, user, db, write=True)
         images = product.product_images.copy() if product.product_images else []
+        all_variants = dict(product.product_image_variants or {})
+        removed = []
         for path in images_path:
             try:
                 images.remove(path)
-                os.remove(path)
-            except (ValueError, FileNotFoundError):
+                variants = all_variants.get(path)
+                if path not in images:
+                    all_variants.pop(path, None)
+                # A single file saved before variants existed
+                removed.append(variants or {'full': {'jpeg': path}})
+            except ValueError:
                 raise HTTPException(
                     status_code=404, detail=f'Could not find "{path}"!')
+        await release_images(db, removed)
         product.product_images = images
-        db.commit()
+        product.product_image_variants = all_variants
+        await db.commit()
+        await invalidate(PRODUCTS)
     except HTTPException as e:
         raise HTTPException(status_code=e.status_code, detail=e.detail)
 
@@ -128,9 +252,14 @@ async def delete_product_images(product_id: Annotated[int, Path(gt=0)], images_p
 @router.delete('/{product_id}')
 async def delete_product(product_id: Annotated[int, Path(gt=0)], user: user_dependency,
                          db: db_dependency):
-    product_query = db.query(Product).filter(Product.product_id == product_id).filter(
-        Product.business.has(Business.owner_id == user['id']))
-    if not product_query:
+    product = (await db.execute(select(
+        Product.business_id, Product.name, Product.category, Product.product_images, Product.product_image_variants
+    ).where(Product.product_id == product_id))).first()
+    if product is None or not await owns_business(user, product.business_id, db, write=True):
         raise HTTPException(status_code=404, detail=('Product not found!'))
-    product_query.delete()
-    db.commit()
+    await release_images(db, referenced_images(product))
+    await db.execute(delete(Product).where(Product.product_id == product_id))
+    await remove_products(db, [product_id])
+    await db.commit()
+    await invalidate(PRODUCTS)
+    track_products(removed=[(product.name, product.category)])
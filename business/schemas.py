@@ -1,16 +1,23 @@
-from pydantic import BaseModel, Field, field_validator
-from database import get_db
-from models import Business
+from pydantic import BaseModel, Field, AfterValidator, field_validator, model_validator
 import datetime
-from typing import Optional
+from typing import Annotated, Optional, Generic, TypeVar
 
+T = TypeVar('T')
 
-def name_validator(name: str):
-    db = next(get_db())
-    errors = []
-    if db.query(Business).filter(Business.business_name == name).first():
-        errors.append('Business name used before!')
-    return errors
+
+def to_utc(value: datetime.datetime) -> datetime.datetime:
+    # Naive dates are taken as UTC, others converted to it. The column is compared with UTC now
+    # and SQLite keeps only the wall time
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+
+UTCDateTime = Annotated[datetime.datetime, AfterValidator(to_utc)]
+
+
+UNIQUE_BUSINESS_ERRORS = {
+    'business_name': 'Invalid business name: Business name used before!'}
 
 
 class CreateBusiness(BaseModel):
@@ -19,12 +26,19 @@ class CreateBusiness(BaseModel):
     region: str = Field(max_length=100, default='Unspecified')
     business_description: str | None = None
 
-    @field_validator('business_name')
-    def name_validation(cls, name: str):
-        errors = name_validator(name)
-        if errors:
-            raise ValueError(f'Invalid business name: {", ".join(errors)}')
-        return name
+
+class ReadBusiness(BaseModel):
+    business_id: int
+    business_name: str
+    city: str
+    region: str
+    business_description: str | None
+    logo: str
+    logo_variants: dict[str, dict[str, str]] | None
+    owner_id: int
+
+    class Config:
+        from_attributes = True
 
 
 class UpdateBusiness(BaseModel):
@@ -37,10 +51,6 @@ class UpdateBusiness(BaseModel):
     def name_validation(cls, name: str):
         if not name or name.isspace():
             return None
-
-        errors = name_validator(name)
-        if errors:
-            raise ValueError(f'Invalid business name: {", ".join(errors)}')
         return name
 
 
@@ -56,7 +66,7 @@ class UpdateProduct(BaseModel):
     category: str = Field(max_length=200, default=None)
     price: Optional[float] = None
     discounted_price: Optional[float] = None
-    offer_expiration_date: Optional[datetime.datetime] = None
+    offer_expiration_date: Optional[UTCDateTime] = None
 
 
 class ReadProduct(BaseModel):
@@ -68,7 +78,56 @@ class ReadProduct(BaseModel):
     discounted_price: float | None
     discount: float | None
     product_images: list[str]
+    product_image_variants: dict[str, dict[str, dict[str, str]]] | None
     date_published: datetime.datetime
+    effective_price: float
+    business_id: int
 
     class Config:
         from_attributes = True
+
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: str | None
+
+
+class ProductFacets(BaseModel):
+    category: dict[str, int]
+    price: dict[str, int]
+
+
+class BusinessFacets(BaseModel):
+    city: dict[str, int]
+    region: dict[str, int]
+
+
+class Suggestion(BaseModel):
+    value: str
+    count: int
+
+
+class CampaignFilter(BaseModel):
+    # Products of one business, optionally narrowed by category and regular price
+    business_id: int
+    category: str | None = None
+    price_le: float | None = None
+    price_ge: float | None = None
+
+
+class CreateCampaign(CampaignFilter):
+    percent_off: float | None = Field(gt=0, lt=100, default=None)
+    amount_off: float | None = Field(gt=0, default=None)
+    offer_expiration_date: UTCDateTime
+
+    @field_validator('offer_expiration_date')
+    def expiration_validation(cls, expiration: datetime.datetime):
+        if expiration <= datetime.datetime.now(datetime.timezone.utc):
+            raise ValueError('Offer expiration date must be in the future')
+        return expiration
+
+    @model_validator(mode='after')
+    def discount_validation(self):
+        if (self.percent_off is None) == (self.amount_off is None):
+            raise ValueError('Give either percent_off or amount_off')
+        return self
@@ -0,0 +1,148 @@
+import re
+from sqlalchemy import text, bindparam, column, select, Integer
+from database import engine
+from models import Product, read_columns
+from .schemas import ReadProduct
+from .pagination import encode_cursor, decode_offset
+
+
+# Config
+SEARCH_TABLE = 'product_search'
+# name, category and business name, the weights ts_rank gives Postgres' A, B and C
+SEARCH_WEIGHTS = (1.0, 0.4, 0.2)
+
+# Every indexed document is built from the product row joined to its business
+_DOCUMENT_SOURCE = """
+    SELECT p.product_id, p.name, p.category, b.business_name
+    FROM products p JOIN businesses b ON b.business_id = p.business_id
+"""
+
+_SQLITE_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE}
+        USING fts5(name, category, business_name, tokenize='unicode61', prefix='2 3')""",
+]
+_SQLITE_INDEX = f"""
+    INSERT INTO {SEARCH_TABLE}(rowid, name, category, business_name)
+    {_DOCUMENT_SOURCE}
+"""
+_SQLITE_REMOVE = f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN :ids"
+_SQLITE_MATCH = f"""
+    SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :query
+    ORDER BY bm25({SEARCH_TABLE}, {', '.join(map(str, SEARCH_WEIGHTS))}), rowid LIMIT :limit OFFSET :offset
+"""
+_SQLITE_FILTER = f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :query"
+
+_PG_DDL = [
+    f"""CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (
+        product_id INTEGER PRIMARY KEY REFERENCES products(product_id) ON DELETE CASCADE,
+        document TSVECTOR NOT NULL)""",
+    f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_document ON {SEARCH_TABLE} USING GIN (document)",
+]
+_PG_INDEX = f"""
+    INSERT INTO {SEARCH_TABLE}(product_id, document)
+    SELECT product_id,
+           setweight(to_tsvector('simple', name), 'A') ||
+           setweight(to_tsvector('simple', category), 'B') ||
+           setweight(to_tsvector('simple', business_name), 'C')
+    FROM ({_DOCUMENT_SOURCE}) AS source
+"""
+_PG_REMOVE = f"DELETE FROM {SEARCH_TABLE} WHERE product_id IN :ids"
+_PG_MATCH = f"""
+    SELECT product_id FROM {SEARCH_TABLE}, to_tsquery('simple', :query) AS q
+    WHERE document @@ q
+    ORDER BY ts_rank(document, q) DESC, product_id LIMIT :limit OFFSET :offset
+"""
+_PG_FILTER = f"SELECT product_id FROM {SEARCH_TABLE} WHERE document @@ to_tsquery('simple', :query)"
+
+
+def _is_postgres() -> bool:
+    return engine.dialect.name == 'postgresql'
+
+
+def build_query(terms: str, name_only: bool = False) -> str | None:
+    # Every word must match, the last one may still be half typed
+    tokens = re.findall(r'\w+', terms.lower())
+    if not tokens:
+        return None
+    if _is_postgres():
+        # Name lexemes carry weight A
+        return ' & '.join(f'{token}:*{"A" if name_only else ""}' for token in tokens)
+    return ' '.join(f'{"name : " if name_only else ""}"{token}"*' for token in tokens)
+
+
+def create_search_index(conn):
+    # Takes a sync connection, it runs from a migration or `AsyncConnection.run_sync`
+    if conn.dialect.name == 'postgresql':
+        existed = conn.scalar(text(f"SELECT to_regclass('{SEARCH_TABLE}')"))
+        for statement in _PG_DDL:
+            conn.execute(text(statement))
+        if not existed:
+            conn.execute(text(_PG_INDEX))
+    else:
+        existed = conn.scalar(text(
+            f"SELECT 1 FROM sqlite_master WHERE name = '{SEARCH_TABLE}'"))
+        for statement in _SQLITE_DDL:
+            conn.execute(text(statement))
+        if not existed:
+            conn.execute(text(_SQLITE_INDEX))
+
+
+def drop_search_index(conn):
+    conn.execute(text(f'DROP TABLE IF EXISTS {SEARCH_TABLE}'))
+
+
+async def remove_products(db, product_ids: list[int]):
+    if not product_ids:
+        return
+    statement = text(_PG_REMOVE if _is_postgres() else _SQLITE_REMOVE).bindparams(
+        bindparam('ids', expanding=True))
+    await db.execute(statement, {'ids': list(product_ids)})
+
+
+async def index_products(db, product_ids: list[int]):
+    # Re-indexing is delete + insert so it works the same for new and changed rows
+    await remove_products(db, product_ids)
+    if not product_ids:
+        return
+    statement = text((_PG_INDEX if _is_postgres() else _SQLITE_INDEX)
+                     + ' WHERE product_id IN :ids').bindparams(bindparam('ids', expanding=True))
+    await db.execute(statement, {'ids': list(product_ids)})
+
+
+async def index_business_products(db, business_id: int):
+    product_ids = (await db.scalars(text(
+        'SELECT product_id FROM products WHERE business_id = :business_id'),
+        {'business_id': business_id})).all()
+    await index_products(db, product_ids)
+
+
+async def search_product_ids(db, terms: str, limit: int, offset: int = 0) -> list[int]:
+    query = build_query(terms)
+    if not query:
+        return []
+    statement = text(_PG_MATCH if _is_postgres() else _SQLITE_MATCH)
+    return (await db.scalars(statement, {'query': query, 'limit': limit, 'offset': offset})).all()
+
+
+def matching_product_ids(terms: str):
+    # Sub-select for `Product.product_id.in_(...)` matching the product name only,
+    # None when there is nothing to match
+    query = build_query(terms, name_only=True)
+    if not query:
+        return None
+    statement = text(_PG_FILTER if _is_postgres() else _SQLITE_FILTER).bindparams(query=query)
+    return statement.columns(column('product_id', Integer))
+
+
+async def search_products(db, terms: str, cursor: str | None, limit: int) -> dict:
+    # Ranked results can't be keyset paginated on the id, the cursor carries the offset
+    offset = decode_offset(cursor)
+    product_ids = await search_product_ids(db, terms, limit + 1, offset)
+    next_cursor = None
+    if len(product_ids) > limit:
+        product_ids = product_ids[:limit]
+        next_cursor = encode_cursor(offset + limit)
+    products = {product['product_id']: dict(product) for product in (await db.execute(
+        select(*read_columns(Product, ReadProduct)).where(Product.product_id.in_(product_ids)))).mappings()}
+    return {'items': [products[product_id] for product_id in product_ids if product_id in products],
+            'next_cursor': next_cursor}
@@ -0,0 +1,220 @@
+import os
+import heapq
+import asyncio
+import logging
+from bisect import bisect_left, insort
+from itertools import groupby
+from collections import Counter, OrderedDict
+from sqlalchemy import select, func
+from database import ReadSessionLocal
+from models import Product, Business
+
+
+# Config
+TYPEAHEAD_REFRESH = int(os.getenv('TYPEAHEAD_REFRESH', 300))  # seconds, picks up writes made by other workers
+TYPEAHEAD_CACHE_SIZE = 4096  # prefixes whose ranked suggestions are kept
+TYPEAHEAD_DEFAULT_LIMIT = 10
+TYPEAHEAD_MAX_LIMIT = 20
+# Values ranked per cached prefix, the slack past the limit absorbs deletes without a rescan
+TYPEAHEAD_RANK_DEPTH = 2 * TYPEAHEAD_MAX_LIMIT
+TYPEAHEAD_WARM_LENGTHS = (1, 2)  # prefix lengths ranked when an index is built
+# Changes up to this size are applied in place, larger ones re-sort the index
+TYPEAHEAD_BISECT_LIMIT = 64
+PRODUCT_FIELDS = ('name', 'category')
+BUSINESS_FIELDS = ('city', 'region')
+# Product names also match from the start of any later word, "sho" finds "red shoe"
+WORD_START_FIELDS = ('name',)
+_COLUMNS = {'name': Product.name, 'category': Product.category,
+            'city': Business.city, 'region': Business.region}
+_END = '\U0010ffff'  # sorts after every character, closes a prefix range
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(value: str) -> str:
+    return ' '.join(value.casefold().split())
+
+
+class PrefixIndex:
+    # Sorted (key, value) pairs searched with bisect, values ranked by how many rows carry them.
+    # Values differing only in case and spacing are one suggestion, shown as first seen
+    def __init__(self, word_starts: bool = False, cache_size: int = TYPEAHEAD_CACHE_SIZE):
+        self.word_starts = word_starts
+        self.cache_size = cache_size
+        self._keys: list[tuple[str, str]] = []
+        self._counts: dict[str, int] = {}
+        self._labels: dict[str, str] = {}
+        # prefix -> [best values in order, whether that is every match]. Kept up to date on writes,
+        # so the short prefixes matching much of the index are rarely ranked from scratch
+        self._results: OrderedDict[str, list] = OrderedDict()
+
+    def _keys_of(self, normalized: str) -> set[str]:
+        if not self.word_starts:
+            return {normalized}
+        words = normalized.split(' ')
+        return {' '.join(words[start:]) for start in range(len(words))}
+
+    def _rank_key(self, normalized: str) -> tuple[int, str]:
+        return -self._counts[normalized], normalized
+
+    def _remember(self, prefix: str, matches) -> list:
+        ranked = heapq.nsmallest(TYPEAHEAD_RANK_DEPTH, set(matches), key=self._rank_key)
+        result = self._results[prefix] = [ranked, len(ranked) < TYPEAHEAD_RANK_DEPTH]
+        while len(self._results) > self.cache_size:
+            self._results.popitem(last=False)
+        return result
+
+    def _rerank(self, normalized: str, increased: bool):
+        # Unlisted values of an incomplete ranking all come after its last value. A value that
+        # falls to the end may belong among them and is dropped; once fewer than the limit are
+        # left the prefix is ranked again on its next lookup
+        prefixes = {key[:end] for key in self._keys_of(normalized) for end in range(1, len(key) + 1)}
+        for prefix in prefixes:
+            result = self._results.get(prefix)
+            if result is None:
+                continue
+            ranked, complete = result
+            if normalized in ranked:
+                if normalized not in self._counts:
+                    ranked.remove(normalized)
+                else:
+                    ranked.sort(key=self._rank_key)
+                    if not increased and not complete and ranked[-1] == normalized:
+                        ranked.pop()
+            elif increased and (complete or self._rank_key(normalized) < self._rank_key(ranked[-1])):
+                ranked.append(normalized)
+                ranked.sort(key=self._rank_key)
+                if len(ranked) > TYPEAHEAD_RANK_DEPTH:
+                    ranked.pop()
+                    result[1] = False
+            if not result[1] and len(ranked) < TYPEAHEAD_MAX_LIMIT:
+                del self._results[prefix]
+
+    def _insert(self, entries: list[tuple[str, str]]):
+        if len(entries) <= TYPEAHEAD_BISECT_LIMIT:
+            for entry in entries:
+                insort(self._keys, entry)
+        else:
+            # Sorting a sorted list with a run appended is close to linear
+            self._keys.extend(entries)
+            self._keys.sort()
+
+    def _delete(self, entries: set[tuple[str, str]]):
+        if len(entries) <= TYPEAHEAD_BISECT_LIMIT:
+            for entry in entries:
+                position = bisect_left(self._keys, entry)
+                if position < len(self._keys) and self._keys[position] == entry:
+                    del self._keys[position]
+        else:
+            self._keys = [entry for entry in self._keys if entry not in entries]
+
+    def apply(self, changes: dict[str, int]):
+        # value -> change in the number of rows carrying it
+        follow = len(changes) <= TYPEAHEAD_BISECT_LIMIT
+        if not follow:
+            # Bulk changes, ranking from scratch is cheaper than following each one
+            self._results.clear()
+        added, removed = [], set()
+        for value, delta in changes.items():
+            normalized = normalize(value)
+            if not normalized or not delta:
+                continue
+            count = self._counts.get(normalized, 0) + delta
+            if count > 0:
+                if normalized not in self._counts:
+                    self._labels[normalized] = ' '.join(value.split())
+                    added += [(key, normalized) for key in self._keys_of(normalized)]
+                self._counts[normalized] = count
+            elif normalized in self._counts:
+                # Never below zero: a row written through another worker may not be counted yet
+                del self._counts[normalized], self._labels[normalized]
+                removed.update((key, normalized) for key in self._keys_of(normalized))
+            else:
+                continue
+            # One change at a time, each ranking update assumes nothing else moved
+            if follow:
+                self._rerank(normalized, delta > 0)
+        # A value removed and added again in one batch keeps its entries
+        kept = removed.intersection(added)
+        self._insert([entry for entry in added if entry not in kept])
+        self._delete(removed - kept)
+
+    def warm(self, lengths: tuple[int, ...] = TYPEAHEAD_WARM_LENGTHS):
+        # The shortest prefixes match the most keys, they are ranked once up front
+        for length in lengths:
+            for prefix, entries in groupby(self._keys, key=lambda entry: entry[0][:length]):
+                if len(prefix) == length:
+                    self._remember(prefix, (normalized for _, normalized in entries))
+
+    def suggest(self, prefix: str, limit: int) -> list[tuple[str, int]]:
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        result = self._results.get(prefix)
+        if result is not None:
+            self._results.move_to_end(prefix)
+        else:
+            start = bisect_left(self._keys, (prefix,))
+            end = bisect_left(self._keys, (prefix + _END,), start)
+            result = self._remember(prefix, (normalized for _, normalized in self._keys[start:end]))
+        return [(self._labels[normalized], self._counts[normalized]) for normalized in result[0][:limit]]
+
+
+def _empty_index(field: str) -> PrefixIndex:
+    return PrefixIndex(word_starts=field in WORD_START_FIELDS)
+
+
+indexes = {field: _empty_index(field) for field in _COLUMNS}
+
+
+def suggest(field: str, prefix: str, limit: int = TYPEAHEAD_DEFAULT_LIMIT) -> list[dict]:
+    return [{'value': value, 'count': count} for value, count in indexes[field].suggest(prefix, limit)]
+
+
+def _track(fields: tuple[str, ...], added, removed):
+    # Rows are tuples in `fields` order; removals go first so a case-only rename keeps the new spelling
+    for position, field in enumerate(fields):
+        changes = Counter()
+        for row in removed:
+            changes[row[position]] -= 1
+        for row in added:
+            changes[row[position]] += 1
+        indexes[field].apply(changes)
+
+
+def track_products(added=(), removed=()):
+    # (name, category) rows, called once the write is committed
+    _track(PRODUCT_FIELDS, added, removed)
+
+
+def track_businesses(added=(), removed=()):
+    # (city, region) rows, called once the write is committed
+    _track(BUSINESS_FIELDS, added, removed)
+
+
+def _build(grouped: dict[str, list]) -> dict[str, PrefixIndex]:
+    fresh = {}
+    for field, rows in grouped.items():
+        fresh[field] = _empty_index(field)
+        fresh[field].apply(dict(rows))
+        fresh[field].warm()
+    return fresh
+
+
+async def load_typeahead():
+    # Grouped in the database, one row per distinct value
+    async with ReadSessionLocal() as db:
+        grouped = {field: (await db.execute(select(column, func.count()).group_by(column))).all()
+                   for field, column in _COLUMNS.items()}
+    # Built aside in a thread and swapped in whole, lookups keep using the old indexes meanwhile.
+    # A write tracked during the build may be missed, the next refresh brings it in
+    indexes.update(await asyncio.to_thread(_build, grouped))
+
+
+async def run_typeahead_refresher():
+    while True:
+        await asyncio.sleep(TYPEAHEAD_REFRESH)
+        try:
+            await load_typeahead()
+        except Exception:
+            logger.exception('Typeahead refresh failed')
@@ -1,44 +1,154 @@
-from io import BytesIO
-from PIL import Image
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import os
-import uuid
-from fastapi import HTTPException, UploadFile
+import hashlib
+from fastapi import HTTPException, UploadFile, status
+from metrics import IMAGE_SECONDS
+from storage import storage
+from .image_store import register_images, mark_stored, acquire_images
+from .imaging import IMAGE_VARIANTS, IMAGE_FORMATS, sniff_image_format, compress_image
 
 
 # Config
-SAVE_DIR = "./static/images"
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB limit
+MAX_UPLOAD_IMAGES = int(os.getenv('MAX_UPLOAD_IMAGES', 10))  # full size images one request can carry
+UPLOAD_CHUNK_SIZE = 64 * 1024
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', os.cpu_count() or 1))
+# Images waiting for or being processed by the pool before uploads get a 503
+IMAGE_QUEUE_DEPTH = int(os.getenv('IMAGE_QUEUE_DEPTH', 4 * IMAGE_WORKERS))
+IMAGE_RETRY_AFTER = 2  # seconds
 
+_executor: ProcessPoolExecutor | None = None
+_pending_images = 0
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def get_image_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'))
+    return _executor
 
-async def save_and_compress_image(image: UploadFile) -> str:
-    # Check if the file has a valid extension
-    if not allowed_file(image.filename):
-        raise HTTPException(status_code=400, detail="Invalid image extension")
 
-    # Check the size of the uploaded file
-    contents = await image.read()
-    if len(contents) > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=400, detail="File size exceeds the maximum limit of 10 MB")
+def _discard_image_executor(executor: ProcessPoolExecutor):
+    # A worker died (out of memory, a crash in Pillow) and took the pool with it, the next upload
+    # starts a new one. Uploads failing together only drop the pool they ran on
+    global _executor
+    if _executor is executor:
+        _executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    # Generate a unique filename using UUID
-    extension = image.filename.rsplit('.', 1)[1].lower()
-    unique_filename = f"{uuid.uuid4()}.{extension}"
 
-    # Convert the contents to a BytesIO object
-    image_file = BytesIO(contents)
-    img = Image.open(image_file)
+def busy() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail="Image processing is busy, try again later",
+                         headers={'Retry-After': str(IMAGE_RETRY_AFTER)})
 
-    # Create the full path for the file
-    file_path = os.path.join(SAVE_DIR, unique_filename)
 
-    # Compress the image and save it
-    img = img.convert("RGB")  # Ensure compatibility with all formats
-    img.save(file_path, format='JPEG', optimize=True, quality=85)
+def shutdown_image_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
 
-    return file_path
+
+def primary_image(variants: dict) -> str:
+    # The full size JPEG is the path kept in `product_images` and `logo`
+    return variants['full']['jpeg']
+
+
+def image_keys(image_hash: str) -> dict:
+    # Sharded on the leading hash digits so no directory or key prefix grows too large
+    return {variant: {image_format: f"{image_hash[:2]}/{image_hash[2:4]}/{image_hash}_{variant}.{extension}"
+                      for image_format, (_, extension, _) in IMAGE_FORMATS.items()}
+            for variant in IMAGE_VARIANTS}
+
+
+def image_urls(keys: dict) -> dict:
+    return {variant: {image_format: storage.url(key) for image_format, key in formats.items()}
+            for variant, formats in keys.items()}
+
+
+async def read_image(image: UploadFile) -> bytes:
+    too_large = HTTPException(
+        status_code=400, detail="File size exceeds the maximum limit of 10 MB")
+    # Bodies too large for any image are refused on Content-Length by the admission middleware,
+    # this catches a single oversized file among several
+    if image.size is not None and image.size > MAX_FILE_SIZE:
+        raise too_large
+
+    contents = bytearray()
+    while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+        if not contents and not sniff_image_format(chunk):
+            # Check the file type from its content, not its name
+            raise HTTPException(status_code=400, detail="Invalid image type")
+        contents.extend(chunk)
+        if len(contents) > MAX_FILE_SIZE:
+            raise too_large
+    if not contents:
+        raise HTTPException(status_code=400, detail="Invalid image type")
+    return bytes(contents)
+
+
+async def _store_image(contents: bytes, image_hash: str):
+    # Resize, compress and encode every variant off the event loop
+    from PIL import Image, UnidentifiedImageError
+    loop = asyncio.get_running_loop()
+    executor = get_image_executor()
+    try:
+        with IMAGE_SECONDS.time():
+            encoded = await loop.run_in_executor(executor, compress_image, contents)
+    except BrokenProcessPool:
+        _discard_image_executor(executor)
+        raise busy()
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=400, detail="Image dimensions exceed the maximum limit")
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    keys = image_keys(image_hash)
+    await asyncio.gather(*(storage.put(keys[variant][image_format], data, f'image/{image_format}')
+                           for variant, formats in encoded.items() for image_format, data in formats.items()))
+
+
+async def save_and_compress_images(images: list[UploadFile], db) -> list[dict]:
+    # Read the uploads in chunks, stopping as soon as one is too large or not an image
+    contents = {}
+    hashes = []
+    for image in images:
+        data = await read_image(image)
+        image_hash = hashlib.sha256(data).hexdigest()
+        contents[image_hash] = data
+        hashes.append(image_hash)
+
+    # Content already in the store is reused as is, only new images go to the pool
+    stored = await register_images({image_hash: image_keys(image_hash) for image_hash in contents})
+    missing = [image_hash for image_hash in contents if image_hash not in stored]
+
+    global _pending_images
+    # Reject the whole batch up front instead of queueing behind a saturated pool
+    if _pending_images + len(missing) > IMAGE_QUEUE_DEPTH:
+        raise busy()
+
+    _pending_images += len(missing)
+    try:
+        results = await asyncio.gather(*(_store_image(contents[image_hash], image_hash)
+                                         for image_hash in missing), return_exceptions=True)
+    finally:
+        _pending_images -= len(missing)
+
+    # Anything written before an error stays unreferenced, the collector removes it
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        raise errors[0]
+    if missing:
+        await mark_stored(missing)
+        stored.update({image_hash: image_keys(image_hash) for image_hash in missing})
+
+    await acquire_images(db, hashes)
+    return [image_urls(stored[image_hash]) for image_hash in hashes]
+
+
+async def save_and_compress_image(image: UploadFile, db) -> dict:
+    return (await save_and_compress_images([image], db))[0]
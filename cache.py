@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict, defaultdict
+from fastapi import Response
+from serialization import dump_json
+
+# Config
+CACHE_URL = os.getenv('CACHE_URL')  # e.g. redis://localhost:6379/0, in-process cache when unset
+CACHE_TTL = int(os.getenv('CACHE_TTL', 60))  # seconds
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 1024))
+# Clients may keep a response but have to revalidate it with its ETag before reuse
+REVALIDATE = 'no-cache'
+
+PRODUCTS = 'products'
+BUSINESSES = 'businesses'
+
+
+class MemoryCache:
+    # LRU of (expires_at, value), counters live apart so eviction can't reset a version
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._counters: dict[str, int] = {}
+
+    async def get(self, key: str) -> bytes | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    async def set(self, key: str, value: bytes, ex: int):
+        self._entries[key] = (time.monotonic() + ex, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        self._counters[key] = self._counters.get(key, 0) + amount
+        return self._counters[key]
+
+
+class RedisCache:
+    # Works with any client exposing the redis.asyncio get/set/incr calls
+    def __init__(self, client):
+        self.client = client
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: bytes, ex: int):
+        await self.client.set(key, value, ex=ex)
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        return await self.client.incr(key, amount)
+
+
+def create_backend():
+    if CACHE_URL:
+        import redis.asyncio as redis
+        return RedisCache(redis.from_url(CACHE_URL))
+    return MemoryCache()
+
+
+backend = create_backend()
+stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'not_modified': 0})
+
+
+def normalize_params(params: dict) -> str:
+    # Unset filters don't change the result, text filters are matched case-insensitively
+    normalized = {key: value.strip().lower() if key == 'name' and isinstance(value, str) else value
+                  for key, value in params.items() if value not in (None, '')}
+    return json.dumps(normalized, sort_keys=True, separators=(',', ':'))
+
+
+async def _version(namespace: str) -> int:
+    # incr by 0 reads the counter and creates it when missing
+    return await backend.incr(f'{namespace}:version', 0)
+
+
+async def invalidate(*namespaces: str):
+    # Bumping the version orphans every key of the namespace, they age out on their own
+    for namespace in namespaces:
+        await backend.incr(f'{namespace}:version')
+
+
+def body_tag(body: bytes) -> str:
+    # Tags name the body itself, a worker that missed an invalidation matches only what it
+    # would still send, and only until its cached entry expires
+    return f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str | None, tag: str) -> bool:
+    # If-None-Match uses the weak comparison, the compression middleware adds an encoding suffix
+    if not if_none_match:
+        return False
+    opaque = tag.strip('"')
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip().removeprefix('W/').strip('"')
+        if candidate == '*' or candidate.split('-')[0] == opaque:
+            return True
+    return False
+
+
+def not_modified(tag: str) -> Response:
+    return Response(status_code=304, headers={'ETag': tag, 'Cache-Control': REVALIDATE})
+
+
+def tagged_json(body: bytes, if_none_match: str | None = None, tag: str | None = None) -> Response:
+    tag = tag or body_tag(body)
+    if etag_matches(if_none_match, tag):
+        return not_modified(tag)
+    return Response(content=body, media_type='application/json',
+                    headers={'ETag': tag, 'Cache-Control': REVALIDATE})
+
+
+async def cached_json(namespace: str, params: dict, build, if_none_match: str | None = None) -> Response:
+    key = f'{namespace}:{await _version(namespace)}:{normalize_params(params)}'
+    entry = await backend.get(key)
+    if entry is None:
+        stats[namespace]['misses'] += 1
+        body = dump_json(await build())
+        tag = body_tag(body)
+        # Stored as `tag\nbody`, a hit is validated without hashing the body again
+        await backend.set(key, tag.encode() + b'\n' + body, ex=CACHE_TTL)
+    else:
+        stats[namespace]['hits'] += 1
+        tag, body = entry.split(b'\n', 1)
+        tag = tag.decode()
+    response = tagged_json(body, if_none_match, tag)
+    if response.status_code == 304:
+        stats[namespace]['not_modified'] += 1
+    return response
+
+
+def cache_stats() -> dict:
+    return {namespace: dict(counts) for namespace, counts in stats.items()}
@@ -0,0 +1,110 @@
+import os
+import zlib
+import brotli
+from starlette.datastructures import Headers, MutableHeaders
+
+# Config
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))  # bytes, smaller bodies go as they are
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4  # fast enough for bodies built per request
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+
+def encoded_tag(tag: str, encoding: str) -> str:
+    # A strong tag names one representation, the encoding is part of it
+    return f'{tag[:-1]}-{encoding}"'
+
+
+def choose_encoding(accept_encoding: str) -> str | None:
+    # Brotli when the client takes it, then gzip, q=0 turns one off
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip().removeprefix('q=')
+        try:
+            accepted[coding.strip()] = float(quality) if quality else 1.0
+        except ValueError:
+            continue
+    for coding in ('br', 'gzip'):
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return None
+
+
+class _Compressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._gzip = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes, last: bool) -> bytes:
+        # Streamed chunks are flushed so a client can use every chunk as it arrives
+        if self.encoding == 'br':
+            return self._brotli.process(data) + (self._brotli.finish() if last else self._brotli.flush())
+        return self._gzip.compress(data) + self._gzip.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    # Plain ASGI like MetricsMiddleware, streamed NDJSON and CSV bodies are compressed chunk by chunk
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        request_headers = Headers(scope=scope)
+        encoding = choose_encoding(request_headers.get('accept-encoding', ''))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor = None
+        passthrough = False
+
+        async def compressing_send(message):
+            nonlocal start, compressor, passthrough
+            if message['type'] == 'http.response.start':
+                if message['status'] == 304:
+                    # No body to go by: the tag keeps the suffix of the representation the client
+                    # holds, so it is the same tag the 200 was sent with
+                    headers = MutableHeaders(raw=message['headers'])
+                    headers.add_vary_header('Accept-Encoding')
+                    etag = headers.get('etag')
+                    if etag and encoded_tag(etag, encoding) in request_headers.get('if-none-match', ''):
+                        headers['ETag'] = encoded_tag(etag, encoding)
+                    passthrough = True
+                    return await send(message)
+                # Held back until the first body chunk shows the size
+                start = message
+                return
+            if message['type'] != 'http.response.body' or passthrough:
+                return await send(message)
+            body, more_body = message.get('body', b''), message.get('more_body', False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start['headers'])
+                compressible = headers.get('content-type', '').startswith(COMPRESSIBLE_TYPES)
+                if compressible:
+                    headers.add_vary_header('Accept-Encoding')
+                if (not compressible or 'content-encoding' in headers
+                        or (not more_body and len(body) < COMPRESS_MIN_SIZE)):
+                    passthrough = True
+                    await send(start)
+                    return await send(message)
+                compressor = _Compressor(encoding)
+                headers['Content-Encoding'] = encoding
+                if 'etag' in headers:
+                    headers['ETag'] = encoded_tag(headers['etag'], encoding)
+                if more_body:
+                    del headers['content-length']
+                    body = compressor.compress(body, last=False)
+                else:
+                    body = compressor.compress(body, last=True)
+                    headers['Content-Length'] = str(len(body))
+                await send(start)
+                return await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+            await send({'type': 'http.response.body', 'body': compressor.compress(body, last=not more_body),
+                        'more_body': more_body})
+
+        await self.app(scope, receive, compressing_send)
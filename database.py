@@ -1,18 +1,136 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from sqlalchemy import event, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from fastapi import Depends
 from typing import Annotated
 
-engine = create_engine('sqlite:///ecom.db')
-SessionLocal = sessionmaker(bind=engine, autoflush=False)
+# Config
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite+aiosqlite:///ecom.db')
+# Read-only routes use their own pool, point it at a replica or leave it on the primary
+READ_DATABASE_URL = os.getenv('READ_DATABASE_URL', DATABASE_URL)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', DB_POOL_SIZE))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+DB_POOL_WARMUP = int(os.getenv('DB_POOL_WARMUP', 2))  # connections each pool opens at startup
+# Run `alembic upgrade head` on startup, turn off when migrations are deployed separately.
+# Workers starting together take turns, see migrate_schema
+DB_MIGRATE_ON_STARTUP = os.getenv('DB_MIGRATE_ON_STARTUP', 'true').lower() == 'true'
+BASE_REVISION = '0000'  # the schema `create_all` made before migrations existed
+MIGRATION_LOCK_ID = 7301  # Postgres advisory lock key
+ALEMBIC_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alembic.ini')
+# Applied to every new SQLite connection. WAL lets readers run while a write is in progress
+SQLITE_PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000)),  # milliseconds
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),  # bytes
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', -64 * 1024)),  # negative is KiB
+}
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+def _create_engine(url: str, pool_size: int, read_only: bool = False):
+    # aiosqlite defaults to NullPool, the pool is set explicitly so it is sized the same on every driver
+    engine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool, pool_size=pool_size,
+                                 max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=DB_POOL_PRE_PING)
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine.sync_engine, 'connect')
+        def configure_sqlite(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in SQLITE_PRAGMAS.items():
+                cursor.execute(f'PRAGMA {name} = {value}')
+            if read_only:
+                # Same file as the primary, a stray write fails instead of taking the write lock
+                cursor.execute('PRAGMA query_only = ON')
+            cursor.close()
+    return engine
+
+
+engine = _create_engine(DATABASE_URL, DB_POOL_SIZE)
+read_engine = _create_engine(READ_DATABASE_URL, DB_READ_POOL_SIZE, read_only=True)
+SessionLocal = async_sessionmaker(
+    bind=engine, autoflush=False, expire_on_commit=False)
+ReadSessionLocal = async_sessionmaker(
+    bind=read_engine, autoflush=False, expire_on_commit=False)
+
+
+async def warm_up_pool(engine, connections: int = DB_POOL_WARMUP):
+    # Opened and configured at startup, returned to the pool for the first requests to reuse
+    opened = await asyncio.gather(*(engine.connect() for _ in range(connections)))
+    for connection in opened:
+        await connection.close()
+
+
+def upgrade_schema(conn):
+    # Called through `AsyncConnection.run_sync`, env.py reuses this connection
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config(ALEMBIC_CONFIG)
+    config.attributes['connection'] = conn
+    tables = inspect(conn).get_table_names()
+    if 'alembic_version' not in tables and 'users' in tables:
+        # Created by `create_all` before migrations existed. It has at least the baseline tables,
+        # the next revision adds whatever later columns and indexes it is missing
+        command.stamp(config, BASE_REVISION)
+    command.upgrade(config, 'head')
+
+
+def _lock_file(lock_file, lock: bool):
+    # Blocks until the lock is free, fcntl is POSIX only, Windows locks the first byte instead
+    if os.name == 'nt':
+        import msvcrt
+        lock_file.seek(0)
+        if not lock:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+        while True:
+            try:
+                # Gives up with an OSError after ten one second tries
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+    import fcntl
+    fcntl.flock(lock_file, fcntl.LOCK_EX if lock else fcntl.LOCK_UN)
+
+
+@asynccontextmanager
+async def _sqlite_migration_lock(engine):
+    # A lock file next to the database, SQLite DDL doesn't wait on another connection's migration
+    database = engine.url.database
+    if engine.dialect.name != 'sqlite' or not database or database == ':memory:':
+        yield
+        return
+    with open(f'{database}.migrate.lock', 'a+') as lock_file:
+        await asyncio.to_thread(_lock_file, lock_file, True)
+        try:
+            yield
+        finally:
+            _lock_file(lock_file, False)
+
+
+async def migrate_schema(engine):
+    # One process at a time, each holds the lock until its upgrade is committed, so the
+    # next one finds the schema at head and has nothing to do
+    async with _sqlite_migration_lock(engine), engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            await conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATION_LOCK_ID})
+        await conn.run_sync(upgrade_schema)
+
+
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
+
+
+async def get_read_db():
+    async with ReadSessionLocal() as db:
         yield db
-    finally:
-        db.close
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+read_db_dependency = Annotated[AsyncSession, Depends(get_read_db)]
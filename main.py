@@ -1,16 +1,79 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from fastapi import FastAPI
-from database import engine
-from models import Base
+from fastapi.responses import ORJSONResponse
+from database import engine, read_engine, migrate_schema, warm_up_pool, DB_MIGRATE_ON_STARTUP
+from cache import cache_stats
+from storage import IMMUTABLE_CACHE_CONTROL
+from metrics import MetricsMiddleware, instrument_engine, metrics_response
+from compression import CompressionMiddleware
+from admission import AdmissionMiddleware
 from users import users
 from business import business, products
+from business.utils import shutdown_image_executor
+from business.offers import run_offer_sweeper
+from business.image_store import run_image_collector
+from business.typeahead import load_typeahead, run_typeahead_refresher
+from users.auth import shutdown_password_executor, token_user_id
+from users.mail import run_mail_worker
+from users.email_verification import load_templates
 from fastapi.staticfiles import StaticFiles
 
-Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+class CachedStaticFiles(StaticFiles):
+    # Images are written once under their content hash (a UUID before) and never change in place
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if 'images' in os.path.normpath(full_path).split(os.sep):
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers['Cache-Control'] = 'public, max-age=3600'
+        return response
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if DB_MIGRATE_ON_STARTUP:
+        await migrate_schema(engine)
+    # Done before the first request instead of during it, the imports behind them stay out of `import main`
+    await asyncio.gather(warm_up_pool(engine), warm_up_pool(read_engine), asyncio.to_thread(load_templates),
+                         load_typeahead())
+    workers = [asyncio.create_task(run_offer_sweeper()), asyncio.create_task(run_mail_worker()),
+               asyncio.create_task(run_image_collector()), asyncio.create_task(run_typeahead_refresher())]
+    yield
+    for worker in workers:
+        worker.cancel()
+    for worker in workers:
+        with suppress(asyncio.CancelledError):
+            await worker
+    shutdown_image_executor()
+    shutdown_password_executor()
+    await engine.dispose()
+    await read_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+# Innermost, a rejected request costs no more than matching its path
+app.add_middleware(AdmissionMiddleware, identify=token_user_id)
+app.add_middleware(CompressionMiddleware)
+# Added last so it is outermost and times compression too
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
+instrument_engine(read_engine)
+
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
 app.include_router(users.route)
 app.include_router(business.router)
 app.include_router(products.router)
+
+
+@app.get('/cache/stats', tags=['cache'])
+async def get_cache_stats():
+    return cache_stats()
+
+
+@app.get('/metrics', include_in_schema=False)
+async def get_metrics():
+    return metrics_response()
@@ -0,0 +1,109 @@
+import os
+import time
+import logging
+from collections import Counter
+from contextvars import ContextVar
+from sqlalchemy import event
+from prometheus_client import Histogram, Gauge, Counter as PromCounter, generate_latest, CONTENT_TYPE_LATEST
+from fastapi import Response
+
+# Config
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 1.0))
+SLOW_REQUEST_MAX_STATEMENTS = 20  # distinct statements listed in a slow request log line
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Request latency, until the body is sent',
+                            ['method', 'route'])
+REQUESTS = PromCounter('http_requests_total', 'Responses by status code', ['method', 'route', 'status'])
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'SQL statements run per request',
+                            ['method', 'route'], buckets=QUERY_COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('http_request_db_seconds', 'Time spent in SQL per request',
+                               ['method', 'route'])
+IMAGE_SECONDS = Histogram('image_processing_seconds', 'Resize and compress time per image, queueing included')
+PASSWORD_SECONDS = Histogram('password_hash_seconds', 'bcrypt time, thread pool queueing included',
+                             ['operation'])
+ADMISSION_WAIT_SECONDS = Histogram('admission_queue_wait_seconds', 'Time admitted requests waited for a slot',
+                                   ['policy'], buckets=(0, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+ADMISSION_REJECTED = PromCounter('admission_rejected_total', 'Requests turned away by admission control',
+                                 ['policy', 'reason'])
+ADMISSION_QUEUED = Gauge('admission_queued_requests', 'Requests waiting for a slot', ['pool'])
+ADMISSION_ACTIVE = Gauge('admission_active_requests', 'Requests holding a slot', ['pool'])
+
+logger = logging.getLogger(__name__)
+# (statement, seconds) for every query of the current request, None outside a request
+_queries: ContextVar[list | None] = ContextVar('queries', default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context.query_start
+    queries = _queries.get()
+    if queries is not None:
+        queries.append((statement, elapsed))
+
+
+def instrument_engine(engine):
+    # The async engine runs its cursors in greenlets that share the request's context
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _route_label(scope) -> str:
+    # Route templates keep the label set small, unmatched paths are folded into one
+    route = scope.get('route')
+    if route is not None:
+        return route.path
+    return scope.get('root_path') or 'unmatched'
+
+
+def _log_slow_request(scope, status: int, elapsed: float, queries: list):
+    # Identical statements are grouped, an N+1 shows up as one line with a large count
+    counts = Counter(statement for statement, _ in queries)
+    seconds = Counter()
+    for statement, query_seconds in queries:
+        seconds[statement] += query_seconds
+    lines = ''.join(f'\n  {count}x {seconds[statement] * 1000:.1f}ms {" ".join(statement.split())[:200]}'
+                    for statement, count in counts.most_common(SLOW_REQUEST_MAX_STATEMENTS))
+    logger.warning('Slow request %s %s -> %s in %.0fms, %d queries in %.0fms%s',
+                   scope['method'], scope['path'], status, elapsed * 1000, len(queries),
+                   sum(seconds.values()) * 1000, lines)
+
+
+class MetricsMiddleware:
+    # Plain ASGI so streamed bodies are timed to the last chunk
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        queries = []
+        token = _queries.set(queries)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _queries.reset(token)
+            method, route = scope['method'], _route_label(scope)
+            REQUEST_SECONDS.labels(method, route).observe(elapsed)
+            REQUESTS.labels(method, route, str(status)).inc()
+            REQUEST_QUERIES.labels(method, route).observe(len(queries))
+            REQUEST_DB_SECONDS.labels(method, route).observe(sum(seconds for _, seconds in queries))
+            if elapsed >= SLOW_REQUEST_SECONDS:
+                _log_slow_request(scope, status, elapsed, queries)
+
+
+def metrics_response() -> Response:
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
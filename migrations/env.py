@@ -0,0 +1,52 @@
+import asyncio
+from logging.config import fileConfig
+from alembic import context
+from database import engine
+from models import Base
+from business.search import SEARCH_TABLE
+
+config = context.config
+# When the app runs the upgrade it hands over its connection and keeps its own logging
+connection = config.attributes.get('connection')
+if config.config_file_name is not None and connection is None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+
+def include_name(name, type_, parent_names):
+    # The search index and its FTS5 shadow tables are managed by business/search.py
+    return not (type_ == 'table' and name.startswith(SEARCH_TABLE))
+
+
+def _configure(**options):
+    # SQLite can't ALTER most things in place, batch mode copies the table instead
+    context.configure(target_metadata=target_metadata, compare_type=True, include_name=include_name,
+                      render_as_batch=engine.dialect.name == 'sqlite', **options)
+
+
+def run_migrations_offline():
+    _configure(url=engine.url.render_as_string(hide_password=False), literal_binds=True,
+               dialect_opts={'paramstyle': 'named'})
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def do_run_migrations(connection):
+    _configure(connection=connection)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_async_migrations():
+    async with engine.begin() as conn:
+        await conn.run_sync(do_run_migrations)
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+elif connection is not None:
+    do_run_migrations(connection)
+else:
+    asyncio.run(run_async_migrations())
@@ -0,0 +1,89 @@
+"""baseline schema
+
+Revision ID: 0000
+Revises: 
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0000'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# The tables as `create_all` made them before migrations existed
+def upgrade() -> None:
+    op.create_table('users',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('username', sa.String(length=50), nullable=False),
+    sa.Column('email', sa.String(length=200), nullable=False),
+    sa.Column('password', sa.String(), nullable=False),
+    sa.Column('is_verified', sa.Boolean(), nullable=False),
+    sa.Column('is_active', sa.Boolean(), nullable=False),
+    sa.Column('created', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_users_email'), ['email'], unique=True)
+        batch_op.create_index(batch_op.f('ix_users_user_id'), ['user_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_users_username'), ['username'], unique=True)
+
+    op.create_table('businesses',
+    sa.Column('business_id', sa.Integer(), nullable=False),
+    sa.Column('business_name', sa.String(length=100), nullable=False),
+    sa.Column('city', sa.String(length=100), nullable=False),
+    sa.Column('region', sa.String(length=100), nullable=False),
+    sa.Column('business_description', sa.String(), nullable=True),
+    sa.Column('logo', sa.String(), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.user_id'], ),
+    sa.PrimaryKeyConstraint('business_id'),
+    sa.UniqueConstraint('business_name')
+    )
+    with op.batch_alter_table('businesses', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_businesses_business_id'), ['business_id'], unique=False)
+
+    op.create_table('products',
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('category', sa.String(), nullable=False),
+    sa.Column('price', sa.Numeric(scale=2), nullable=False),
+    sa.Column('discount', sa.Numeric(scale=2), nullable=True),
+    sa.Column('discounted_price', sa.Numeric(scale=2), nullable=True),
+    sa.Column('offer_expiration_date', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('product_images', sa.JSON(), nullable=False),
+    sa.Column('date_published', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.Column('business_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['business_id'], ['businesses.business_id'], ),
+    sa.PrimaryKeyConstraint('product_id')
+    )
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_products_category'), ['category'], unique=False)
+        batch_op.create_index(batch_op.f('ix_products_name'), ['name'], unique=False)
+        batch_op.create_index(batch_op.f('ix_products_product_id'), ['product_id'], unique=False)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_products_product_id'))
+        batch_op.drop_index(batch_op.f('ix_products_name'))
+        batch_op.drop_index(batch_op.f('ix_products_category'))
+
+    op.drop_table('products')
+    with op.batch_alter_table('businesses', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_businesses_business_id'))
+
+    op.drop_table('businesses')
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_users_username'))
+        batch_op.drop_index(batch_op.f('ix_users_user_id'))
+        batch_op.drop_index(batch_op.f('ix_users_email'))
+
+    op.drop_table('users')
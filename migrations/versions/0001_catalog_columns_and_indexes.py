@@ -0,0 +1,75 @@
+"""catalog columns, indexes and search table
+
+Revision ID: 0001
+Revises: 0000
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from business.search import create_search_index, drop_search_index
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, None] = '0000'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (table, index, columns) added after the baseline
+INDEXES = [
+    ('businesses', 'ix_businesses_city_region', ['city', 'region']),
+    ('businesses', 'ix_businesses_owner_id', ['owner_id']),
+    ('businesses', 'ix_businesses_region', ['region']),
+    ('products', 'ix_products_business_id', ['business_id']),
+    ('products', 'ix_products_category_effective_price', ['category', 'effective_price']),
+    ('products', 'ix_products_effective_price', ['effective_price']),
+    ('products', 'ix_products_offer_expiration_date', ['offer_expiration_date']),
+]
+
+
+# Databases created by `create_all` between the baseline and migrations have some of these
+# already, only what is missing is added
+def _columns(table: str) -> set[str]:
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def _indexes(table: str) -> set[str]:
+    return {index['name'] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade() -> None:
+    if 'logo_variants' not in _columns('businesses'):
+        with op.batch_alter_table('businesses', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('logo_variants', sa.JSON(), nullable=True))
+
+    columns = _columns('products')
+    if 'product_image_variants' not in columns:
+        with op.batch_alter_table('products', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('product_image_variants', sa.JSON(), nullable=False,
+                                          server_default='{}'))
+    if 'effective_price' not in columns:
+        # SQLite only adds virtual generated columns in place, the table is copied instead
+        with op.batch_alter_table('products', schema=None, recreate='always') as batch_op:
+            batch_op.add_column(sa.Column('effective_price', sa.Numeric(scale=2), sa.Computed(
+                'COALESCE(discounted_price, price)', persisted=True), nullable=False))
+
+    for table, name, index_columns in INDEXES:
+        if name not in _indexes(table):
+            op.create_index(name, table, index_columns, unique=False)
+
+    # FTS5 on SQLite, tsvector + GIN on Postgres, filled from the existing products
+    create_search_index(op.get_bind())
+
+
+def downgrade() -> None:
+    drop_search_index(op.get_bind())
+    for table, name, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.drop_column('effective_price')
+        batch_op.drop_column('product_image_variants')
+    with op.batch_alter_table('businesses', schema=None) as batch_op:
+        batch_op.drop_column('logo_variants')
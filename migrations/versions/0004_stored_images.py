@@ -0,0 +1,38 @@
+"""stored images
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('stored_images',
+    sa.Column('image_hash', sa.String(length=64), nullable=False),
+    sa.Column('variants', sa.JSON(), nullable=False),
+    sa.Column('refcount', sa.Integer(), nullable=False),
+    sa.Column('stored_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('orphaned_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('image_hash')
+    )
+    with op.batch_alter_table('stored_images', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_stored_images_orphaned_at'), ['orphaned_at'], unique=False)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('stored_images', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_stored_images_orphaned_at'))
+
+    op.drop_table('stored_images')
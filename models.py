@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKey, TIMESTAMP, String, Numeric, JSON
+from sqlalchemy import ForeignKey, TIMESTAMP, String, Numeric, JSON, Computed, Index, Text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 import datetime
 from decimal import Decimal
@@ -8,6 +8,12 @@ class Base(DeclarativeBase):
     pass
 
 
+def read_columns(model, schema) -> list:
+    # The table columns behind a read schema, selected directly instead of hydrating ORM objects.
+    # Labels make the row keys plain str, explicitly named columns are keyed by a str subclass
+    return [model.__table__.c[name].label(name) for name in schema.model_fields]
+
+
 class User(Base):
     __tablename__ = 'users'
 
@@ -29,15 +35,21 @@ class Business(Base):
     business_id: Mapped[int] = mapped_column(primary_key=True, index=True)
     business_name: Mapped[str] = mapped_column(String(100), unique=True)
     city: Mapped[str] = mapped_column(String(100), default='Unspecified')
-    region: Mapped[str] = mapped_column(String(100), default='Unspecified')
+    region: Mapped[str] = mapped_column(
+        String(100), default='Unspecified', index=True)
     business_description: Mapped[str | None] = mapped_column(nullable=True)
     logo: Mapped[str] = mapped_column(default='/static/images/default.jpg')
+    logo_variants: Mapped[dict | None] = mapped_column(
+        JSON, nullable=True, default=None)
 
-    owner_id: Mapped[int] = mapped_column(ForeignKey('users.user_id'))
+    owner_id: Mapped[int] = mapped_column(
+        ForeignKey('users.user_id'), index=True)
 
     owner: Mapped[User] = relationship(back_populates='businesses')
     products: Mapped[list['Product']] = relationship(back_populates='business')
 
+    __table_args__ = (Index('ix_businesses_city_region', 'city', 'region'),)
+
 
 class Product(Base):
     __tablename__ = 'products'
@@ -51,16 +63,27 @@ class Product(Base):
     _discounted_price: Mapped[Decimal | None] = mapped_column('discounted_price',
                                                               Numeric(scale=2), nullable=True, default=None)
     offer_expiration_date: Mapped[datetime.datetime | None] = mapped_column(
-        TIMESTAMP(timezone=True), nullable=True)
+        TIMESTAMP(timezone=True), nullable=True, index=True)
+    # What the product sells for right now, generated by the database so every
+    # write path (ORM, bulk inserts, set-based updates) keeps it in step
+    effective_price: Mapped[Decimal] = mapped_column(
+        Numeric(scale=2), Computed('COALESCE(discounted_price, price)', persisted=True), index=True)
     product_images: Mapped[list[str]] = mapped_column(JSON, default=[])
+    # Resized WebP/JPEG variants keyed by the matching `product_images` path
+    product_image_variants: Mapped[dict[str, dict]] = mapped_column(
+        JSON, default={})
     date_published: Mapped[datetime.datetime] = mapped_column(
         TIMESTAMP(timezone=True), default=datetime.datetime.now(datetime.timezone.utc))
 
     business_id: Mapped[int] = mapped_column(
-        ForeignKey('businesses.business_id'))
+        ForeignKey('businesses.business_id'), index=True)
 
     business: Mapped[Business] = relationship(back_populates='products')
 
+    # Fetch effective_price back with RETURNING instead of a lazy load later on
+    __mapper_args__ = {'eager_defaults': True}
+    __table_args__ = (Index('ix_products_category_effective_price', 'category', 'effective_price'),)
+
     @property
     def discounted_price(self):
         return self._discounted_price
@@ -70,6 +93,55 @@ class Product(Base):
         if value is None:
             self._discounted_price = None
         else:
-            self._discounted_price = value
-            self.discount = (self.price - self._discounted_price) / \
-                self.price * 100 if self.price != 0 else 0
+            # Loaded prices are Decimal while request values are float
+            price = Decimal(str(self.price))
+            self._discounted_price = Decimal(str(value))
+            self.discount = (price - self._discounted_price) / \
+                price * 100 if price != 0 else 0
+
+
+class CatalogFacet(Base):
+    # Unfiltered facet counts, kept current by the triggers in business/facets.py
+    __tablename__ = 'catalog_facets'
+
+    facet: Mapped[str] = mapped_column(String(20), primary_key=True)
+    value: Mapped[str] = mapped_column(String(200), primary_key=True)
+    count: Mapped[int] = mapped_column(default=0)
+
+
+class OutboundEmail(Base):
+    __tablename__ = 'outbound_emails'
+
+    email_id: Mapped[int] = mapped_column(primary_key=True)
+    recipient: Mapped[str] = mapped_column(String(200))
+    subject: Mapped[str] = mapped_column(String(200))
+    html: Mapped[str] = mapped_column(Text)
+    # pending -> sent, or failed once every attempt is used up
+    status: Mapped[str] = mapped_column(String(20), default='pending')
+    attempts: Mapped[int] = mapped_column(default=0)
+    # Also the claim lease: a worker pushes it forward before sending
+    next_attempt_at: Mapped[datetime.datetime] = mapped_column(
+        TIMESTAMP(timezone=True), default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created: Mapped[datetime.datetime] = mapped_column(
+        TIMESTAMP(timezone=True), default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    sent_at: Mapped[datetime.datetime | None] = mapped_column(
+        TIMESTAMP(timezone=True), nullable=True)
+
+    __table_args__ = (Index('ix_outbound_emails_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+
+class StoredImage(Base):
+    # One row per uploaded image content, shared by every product or logo that uses it
+    __tablename__ = 'stored_images'
+
+    image_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    # Storage keys by variant and format
+    variants: Mapped[dict] = mapped_column(JSON)
+    refcount: Mapped[int] = mapped_column(default=0)
+    # Set once every variant is written, only then can another upload reuse them
+    stored_at: Mapped[datetime.datetime | None] = mapped_column(
+        TIMESTAMP(timezone=True), nullable=True)
+    # Set when the last reference goes away, the collector deletes it after a grace period
+    orphaned_at: Mapped[datetime.datetime | None] = mapped_column(
+        TIMESTAMP(timezone=True), nullable=True, index=True)
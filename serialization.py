@@ -0,0 +1,13 @@
+from decimal import Decimal
+import orjson
+
+
+def _default(value):
+    # Numeric columns are read as Decimal, the read schemas declare them as float
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dump_json(data) -> bytes:
+    return orjson.dumps(data, default=_default)
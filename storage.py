@@ -0,0 +1,90 @@
+import os
+import asyncio
+import tempfile
+
+# Config
+STORAGE_URL = os.getenv('STORAGE_URL')  # e.g. s3://bucket-name, local disk when unset
+STORAGE_DIR = os.getenv('STORAGE_DIR', './static/images')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')  # any S3-compatible server, AWS when unset
+# Base URL the stored objects are served from, e.g. a CDN in front of the bucket
+STORAGE_PUBLIC_URL = os.getenv('STORAGE_PUBLIC_URL')
+S3_DELETE_BATCH = 1000  # most keys a DeleteObjects call takes
+# Keys are content hashes, an object never changes once written
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class LocalStorage:
+    # Files under `root`, their path doubles as the URL the static mount serves
+    def __init__(self, root: str = STORAGE_DIR):
+        self.root = root
+
+    def url(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def key(self, url: str) -> str | None:
+        # None for a path outside the store
+        key = os.path.relpath(url, self.root)
+        return None if key.startswith(os.pardir) or os.path.isabs(key) else key
+
+    def _write(self, key: str, data: bytes):
+        path = self.url(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name first so a reader never sees half a file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _delete(self, keys: list[str]):
+        for key in keys:
+            try:
+                os.remove(self.url(key))
+            except FileNotFoundError:
+                pass
+
+    async def put(self, key: str, data: bytes, content_type: str):
+        await asyncio.to_thread(self._write, key, data)
+
+    async def delete(self, keys: list[str]):
+        await asyncio.to_thread(self._delete, keys)
+
+
+class S3Storage:
+    # Works with any client exposing the boto3 put_object/delete_objects calls
+    def __init__(self, client, bucket: str, public_url: str):
+        self.client = client
+        self.bucket = bucket
+        self.public_url = public_url.rstrip('/')
+
+    def url(self, key: str) -> str:
+        return f'{self.public_url}/{key}'
+
+    def key(self, url: str) -> str | None:
+        prefix = f'{self.public_url}/'
+        return url.removeprefix(prefix) if url.startswith(prefix) else None
+
+    async def put(self, key: str, data: bytes, content_type: str):
+        await asyncio.to_thread(self.client.put_object, Bucket=self.bucket, Key=key, Body=data,
+                                ContentType=content_type, CacheControl=IMMUTABLE_CACHE_CONTROL)
+
+    async def delete(self, keys: list[str]):
+        for start in range(0, len(keys), S3_DELETE_BATCH):
+            objects = [{'Key': key} for key in keys[start:start + S3_DELETE_BATCH]]
+            await asyncio.to_thread(self.client.delete_objects, Bucket=self.bucket,
+                                    Delete={'Objects': objects, 'Quiet': True})
+
+
+def create_storage():
+    if STORAGE_URL and STORAGE_URL.startswith('s3://'):
+        import boto3
+        bucket = STORAGE_URL.removeprefix('s3://').strip('/')
+        public_url = STORAGE_PUBLIC_URL or f'{S3_ENDPOINT_URL or "https://s3.amazonaws.com"}/{bucket}'
+        return S3Storage(boto3.client('s3', endpoint_url=S3_ENDPOINT_URL), bucket, public_url)
+    return LocalStorage()
+
+
+storage = create_storage()
@@ -0,0 +1,78 @@
+import os
+import socket
+import tempfile
+
+# Set before the app modules read their config
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{tempfile.mkdtemp()}/test.db'
+os.environ['READ_DATABASE_URL'] = os.environ['DATABASE_URL']
+
+import pytest
+from aiosmtpd.controller import Controller
+from sqlalchemy import delete
+from database import engine, SessionLocal, migrate_schema
+from models import OutboundEmail
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def anyio_backend():
+    # One event loop for the whole run, the engine's pooled connections belong to it
+    return 'asyncio'
+
+
+@pytest.fixture(scope='session')
+async def schema(anyio_backend):
+    await migrate_schema(engine)
+    yield
+    await engine.dispose()
+
+
+@pytest.fixture
+async def db(schema):
+    async with SessionLocal() as session:
+        yield session
+        await session.execute(delete(OutboundEmail))
+        await session.commit()
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        # The peer address tells connections apart
+        self.messages.append((session.peer, envelope))
+        return '250 OK'
+
+
+def use_smtp(monkeypatch, port: int):
+    from users import smtp
+    monkeypatch.setattr(smtp, 'SMTP_HOST', '127.0.0.1')
+    monkeypatch.setattr(smtp, 'SMTP_PORT', port)
+    monkeypatch.setattr(smtp, 'SMTP_USE_TLS', False)
+    monkeypatch.setattr(smtp, 'SMTP_USER', None)
+    monkeypatch.setattr(smtp, 'SMTP_PASSWORD', None)
+    monkeypatch.setattr(smtp, 'FROM_EMAIL', 'shop@example.com')
+    monkeypatch.setattr(smtp, 'MAIL_RATE_LIMIT', 1000)
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    use_smtp(monkeypatch, controller.port)
+    yield handler
+    controller.stop()
+
+
+@pytest.fixture
+def smtp_down(monkeypatch):
+    # Nothing listens on the port, connecting is refused
+    use_smtp(monkeypatch, free_port())
@@ -0,0 +1,45 @@
+import datetime
+import pytest
+from sqlalchemy import select
+from models import OutboundEmail
+from users.mail import enqueue_email, claim_batch, deliver_batch, MAIL_RETRY_DELAY
+from users.smtp import SMTPConnection
+
+pytestmark = pytest.mark.anyio
+
+
+async def queue(db, count: int):
+    for number in range(count):
+        enqueue_email(db, f'user{number}@example.com', 'Verify your email', '<p>Hello</p>')
+    await db.commit()
+
+
+async def test_batch_is_sent_over_one_connection(db, smtp_server):
+    await queue(db, 3)
+    connection = SMTPConnection()
+    emails = await claim_batch(db)
+    assert await deliver_batch(db, emails, connection) == 3
+    await connection.close()
+
+    assert sorted(envelope.rcpt_tos[0] for _, envelope in smtp_server.messages) == [
+        'user0@example.com', 'user1@example.com', 'user2@example.com']
+    assert len({peer for peer, _ in smtp_server.messages}) == 1
+    assert set(await db.scalars(select(OutboundEmail.status))) == {'sent'}
+
+
+async def test_server_down_keeps_email_pending_with_a_retry(db, smtp_down):
+    await queue(db, 1)
+    connection = SMTPConnection()
+    before = datetime.datetime.now(datetime.timezone.utc)
+    await deliver_batch(db, await claim_batch(db), connection)
+
+    db.expire_all()
+    email = await db.scalar(select(OutboundEmail))
+    assert email.status == 'pending'
+    assert email.attempts == 1
+    assert email.last_error
+    # SQLite hands back naive UTC
+    retry_at = email.next_attempt_at.replace(tzinfo=datetime.timezone.utc)
+    assert retry_at >= before + datetime.timedelta(seconds=MAIL_RETRY_DELAY)
+    # Not due yet, the next claim leaves it alone
+    assert await claim_batch(db) == []
@@ -0,0 +1,96 @@
+# Fails when a catalog listing or ownership query stops using an index
+import datetime
+import itertools
+import pytest
+from sqlalchemy import select
+from database import engine
+from models import Business, Product
+from users.auth import owned_business_query
+from business.business import filter_businesses
+from business.products import filter_products, PRODUCT_SORTS
+from business.pagination import after_cursor, encode_cursor, DEFAULT_PAGE_SIZE
+from business.offers import expired_offers_query
+from users.mail import due_emails_query
+from business.image_store import orphaned_images_query
+from business.campaigns import campaign_filter
+from business.schemas import CampaignFilter
+
+PRODUCT_FILTERS = {'name': 'shoe', 'category': 'Shoes', 'price_le': 100, 'price_ge': 10}
+BUSINESS_FILTERS = {'business_owner': 'owner', 'city': 'Cairo', 'region': 'Giza'}
+TABLES = ('products', 'businesses', 'users', 'outbound_emails', 'stored_images')
+
+pytestmark = pytest.mark.anyio
+
+
+def _subsets(filters: dict):
+    for size in range(len(filters) + 1):
+        for names in itertools.combinations(filters, size):
+            yield {name: filters[name] for name in names}
+
+
+def _cursor(key) -> str:
+    return encode_cursor([10.5, 1] if isinstance(key, tuple) else 1)
+
+
+def _needs_index(filters: dict, sort: str, cursor: str | None) -> bool:
+    if not filters and not cursor:
+        # Unfiltered first page, the scan in key order stops after LIMIT rows
+        return False
+    if sort == 'id' and not cursor and len(filters) == 1 and set(filters) <= {'price_le', 'price_ge'}:
+        # A lone price bound in id order walks the primary key until LIMIT rows match,
+        # the price index would have to sort every matching row instead
+        return False
+    return True
+
+
+def cases():
+    # (description, statement) of every query that must only search indexes
+    for filters in _subsets(PRODUCT_FILTERS):
+        for sort, (key, descending) in PRODUCT_SORTS.items():
+            for cursor in (None, _cursor(key)):
+                if _needs_index(filters, sort, cursor):
+                    statement = after_cursor(filter_products(**filters), key, cursor, descending)
+                    yield (f'GET /product/ {filters} sort={sort} cursor={bool(cursor)}',
+                           statement.limit(DEFAULT_PAGE_SIZE + 1))
+    for filters in _subsets(BUSINESS_FILTERS):
+        for cursor in (None, _cursor(Business.business_id)):
+            # Like products, an unfiltered first page stops after LIMIT rows of the primary key
+            if filters or cursor:
+                statement = after_cursor(filter_businesses(**filters), Business.business_id, cursor)
+                yield (f'GET /business/ {filters} cursor={bool(cursor)}',
+                       statement.limit(DEFAULT_PAGE_SIZE + 1))
+    now = datetime.datetime.now(datetime.timezone.utc)
+    yield 'principal business ids', owned_business_query(1)
+    yield 'business ownership check', owned_business_query(1, 1)
+    yield 'product by id', select(Product).where(Product.product_id == 1)
+    yield 'business catalog export', select(Product).where(
+        Product.business_id == 1).order_by(Product.product_id)
+    yield 'expired offer sweep', expired_offers_query(now)
+    yield 'due email claim', due_emails_query(now)
+    yield 'orphaned images', orphaned_images_query(now)
+    yield 'campaign products', select(Product.product_id).where(*campaign_filter(
+        CampaignFilter(business_id=1, category='General', price_ge=10)))
+
+
+def full_scans(plan: list[str]) -> list[str]:
+    # "SEARCH t USING ..." is an index lookup, "SCAN t" and "SCAN t USING INDEX" read every row
+    return [detail for detail in plan
+            if detail.startswith('SCAN ') and detail.split()[1] in TABLES]
+
+
+async def explain(conn, statement) -> list[str]:
+    compiled = statement.compile(dialect=conn.dialect, compile_kwargs={'render_postcompile': True})
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    result = await conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params)
+    return [row[3] for row in result.all()]
+
+
+CASES = list(cases())
+
+
+@pytest.mark.parametrize('statement', [statement for _, statement in CASES],
+                         ids=[description for description, _ in CASES])
+async def test_query_uses_indexes(schema, statement):
+    async with engine.connect() as conn:
+        plan = await explain(conn, statement)
+    assert not full_scans(plan), '\n'.join(plan)
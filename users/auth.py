@@ -1,6 +1,12 @@
 import os
-from passlib.context import CryptContext
-from models import User
+import time
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from database import read_db_dependency
+from metrics import PASSWORD_SECONDS
+from models import User, Business
+from sqlalchemy import select
 from jose import jwt, JWTError
 import datetime
 from fastapi.security import OAuth2PasswordBearer
@@ -8,16 +14,64 @@ from fastapi import Depends, HTTPException, status
 from typing import Annotated
 
 
-bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-oauth2_bearer = OAuth2PasswordBearer(tokenUrl='user-api/token')
-
 KEY = os.getenv('SECRET_KEY')
 ALGORITHM = 'HS256'
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+# bcrypt releases the GIL, so threads hash in parallel up to this many at a time
+PASSWORD_WORKERS = int(os.getenv('PASSWORD_WORKERS', os.cpu_count() or 1))
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', 1024))
+# Entries expire with their token, or after this many seconds so changes made
+# through another worker are picked up
+AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', 300))
+
+oauth2_bearer = OAuth2PasswordBearer(tokenUrl='user-api/token')
+
+_password_executor: ThreadPoolExecutor | None = None
+_bcrypt_context = None
+# token -> (expires_at, principal)
+_principals: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+
+def get_bcrypt_context():
+    # passlib and bcrypt load on the first login or signup, token checks never need them
+    global _bcrypt_context
+    if _bcrypt_context is None:
+        from passlib.context import CryptContext
+        _bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto', bcrypt__rounds=BCRYPT_ROUNDS)
+    return _bcrypt_context
+
+
+def get_password_executor() -> ThreadPoolExecutor:
+    global _password_executor
+    if _password_executor is None:
+        _password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS,
+                                                thread_name_prefix='password')
+    return _password_executor
 
 
-def authenticate_user(username, password, db):
-    user = db.query(User).filter(User.username == username).first()
-    if user and bcrypt_context.verify(password, user.password):
+def shutdown_password_executor():
+    global _password_executor
+    if _password_executor is not None:
+        _password_executor.shutdown(wait=True, cancel_futures=True)
+        _password_executor = None
+
+
+async def hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    with PASSWORD_SECONDS.labels('hash').time():
+        return await loop.run_in_executor(get_password_executor(), get_bcrypt_context().hash, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    with PASSWORD_SECONDS.labels('verify').time():
+        return await loop.run_in_executor(get_password_executor(), get_bcrypt_context().verify,
+                                          password, hashed_password)
+
+
+async def authenticate_user(username, password, db):
+    user = await db.scalar(select(User).where(User.username == username))
+    if user and await verify_password(password, user.password):
         return user
     return False
 
@@ -28,7 +82,62 @@ def gen_token(user_id, username, expires_delta):
     return jwt.encode(encode, key=KEY, algorithm=ALGORITHM)
 
 
-def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
+def _cached_principal(token: str) -> dict | None:
+    entry = _principals.get(token)
+    if entry is None:
+        return None
+    if entry[0] <= time.time():
+        del _principals[token]
+        return None
+    _principals.move_to_end(token)
+    return entry[1]
+
+
+def _cache_principal(token: str, principal: dict, expires_at: float):
+    _principals[token] = (min(expires_at, time.time() + AUTH_CACHE_TTL), principal)
+    _principals.move_to_end(token)
+    while len(_principals) > AUTH_CACHE_SIZE:
+        _principals.popitem(last=False)
+
+
+def token_user_id(token: str) -> int | None:
+    # Signature and expiry only, no database: admission control keys rate limits on it
+    principal = _cached_principal(token)
+    if principal:
+        return principal['id']
+    try:
+        return jwt.decode(token, KEY, algorithms=[ALGORITHM]).get('id')
+    except JWTError:
+        return None
+
+
+def invalidate_user(user_id: int):
+    for token in [token for token, (_, principal) in _principals.items() if principal['id'] == user_id]:
+        del _principals[token]
+
+
+def owned_business_query(user_id: int, business_id: int | None = None):
+    query = select(Business.business_id).where(Business.owner_id == user_id)
+    if business_id is not None:
+        query = query.where(Business.business_id == business_id)
+    return query
+
+
+async def load_principal(user_id: int, db) -> dict | None:
+    user = (await db.execute(select(User.username, User.email, User.is_active, User.is_verified)
+                             .where(User.user_id == user_id))).first()
+    if not user:
+        return None
+    business_ids = (await db.scalars(owned_business_query(user_id))).all()
+    return {'username': user.username, 'id': user_id, 'email': user.email,
+            'is_active': user.is_active, 'is_verified': user.is_verified,
+            'business_ids': set(business_ids)}
+
+
+async def get_current_user(token: Annotated[str, Depends(oauth2_bearer)], db: read_db_dependency):
+    principal = _cached_principal(token)
+    if principal:
+        return principal
     try:
         payload = jwt.decode(token, KEY, algorithms=[ALGORITHM])
         username: str = payload.get('sub')
@@ -36,13 +145,31 @@ def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
         if not username or not user_id:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                                 detail='Could not validate user.')
-        return {'username': username, 'id': user_id}
     except:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail='Could not validate user.')
+    principal = await load_principal(user_id, db)
+    if not principal or not principal['is_active']:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail='Could not validate user.')
+    _cache_principal(token, principal, payload['exp'])
+    return principal
+
+
+async def owns_business(user: dict, business_id: int, db, write: bool = False) -> bool:
+    # Writes always ask the database, a business deleted through another worker stays in this
+    # worker's cached principals until they expire, and its id may be reused
+    if not write and business_id in user['business_ids']:
+        return True
+    # Businesses created through another worker aren't in this principal yet
+    if await db.scalar(owned_business_query(user['id'], business_id)):
+        user['business_ids'].add(business_id)
+        return True
+    user['business_ids'].discard(business_id)
+    return False
 
 
-user_dependency = Annotated[User, Depends(get_current_user)]
+user_dependency = Annotated[dict, Depends(get_current_user)]
 
 
 def get_email_user(token: str):
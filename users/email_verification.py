@@ -1,39 +1,34 @@
-from fastapi.templating import Jinja2Templates
-from fastapi import Request
-import aiosmtplib
-from email.message import EmailMessage
-import os
 from .auth import gen_token
-from models import User
+from .mail import enqueue_email
 from datetime import timedelta
 
 
-templates = Jinja2Templates(directory="templates")
+TEMPLATE_DIR = "templates"
+# Compiled ahead by load_templates() at startup, every email only renders it
+VERIFICATION_TEMPLATE = 'verification_email.html'
+VERIFIED_PAGE = 'verified.html'
+VERIFICATION_SUBJECT = 'EasyShopas Account Verification'
 
-SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
-SMTP_PORT = int(os.getenv("SMTP_PORT", 465))
-SMTP_USER = os.getenv("SMTP_USER")
-SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
-FROM_EMAIL = os.getenv("FROM_EMAIL")
+_templates = None
 
 
-async def email_verify(user, request, db):
-    token = gen_token(user['id'], user['username'], timedelta(hours=2))
+def get_templates():
+    # Jinja2 is imported on first use, importing the app doesn't load it
+    global _templates
+    if _templates is None:
+        from fastapi.templating import Jinja2Templates
+        _templates = Jinja2Templates(directory=TEMPLATE_DIR)
+    return _templates
+
+
+def load_templates():
+    # The environment caches compiled templates, later get_template calls are lookups
+    for name in (VERIFICATION_TEMPLATE, VERIFIED_PAGE):
+        get_templates().get_template(name)
 
-    useremail = db.query(User).filter(User.user_id == user['id']).first().email
-    template = templates.get_template(
-        'verification_email.html').render({'request': request, 'token': token})
-    message = EmailMessage()
-    message["From"] = FROM_EMAIL
-    message["To"] = useremail
-    message["Subject"] = 'EasyShopas Account Verification'
-    message.add_alternative(template, subtype='html')
-
-    await aiosmtplib.send(
-        message,
-        hostname=SMTP_HOST,
-        port=SMTP_PORT,
-        username=SMTP_USER,
-        password=SMTP_PASSWORD,
-        use_tls=True,
-    )
+
+def email_verify(user, db):
+    # Queued in the caller's transaction, users/mail.py delivers it
+    token = gen_token(user['id'], user['username'], timedelta(hours=2))
+    html = get_templates().get_template(VERIFICATION_TEMPLATE).render({'token': token})
+    enqueue_email(db, user['email'], VERIFICATION_SUBJECT, html)
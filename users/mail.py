@@ -0,0 +1,115 @@
+import os
+import asyncio
+import logging
+import datetime
+from sqlalchemy import select, update
+from database import SessionLocal
+from models import OutboundEmail
+
+
+# Config
+MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', 50))
+MAIL_POLL_INTERVAL = int(os.getenv('MAIL_POLL_INTERVAL', 30))  # seconds, enqueue wakes the worker early
+MAIL_MAX_ATTEMPTS = int(os.getenv('MAIL_MAX_ATTEMPTS', 5))
+MAIL_RETRY_DELAY = 30  # seconds, doubled after every failed attempt
+MAIL_CLAIM_TIMEOUT = 300  # seconds before a claimed but unfinished email is picked up again
+SMTP_IDLE_TIMEOUT = int(os.getenv('SMTP_IDLE_TIMEOUT', 60))  # seconds an unused connection stays open
+
+logger = logging.getLogger(__name__)
+_wakeup = asyncio.Event()
+
+
+def enqueue_email(db, recipient: str, subject: str, html: str):
+    # Part of the caller's transaction, call notify_mail_worker() after the commit
+    db.add(OutboundEmail(recipient=recipient, subject=subject, html=html))
+
+
+def notify_mail_worker():
+    _wakeup.set()
+
+
+def retry_delay(attempts: int) -> datetime.timedelta:
+    return datetime.timedelta(seconds=MAIL_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def due_emails_query(now: datetime.datetime):
+    return select(OutboundEmail.email_id).where(
+        OutboundEmail.status == 'pending', OutboundEmail.next_attempt_at <= now
+    ).order_by(OutboundEmail.next_attempt_at).limit(MAIL_BATCH_SIZE)
+
+
+async def claim_batch(db) -> list[OutboundEmail]:
+    # Moving next_attempt_at forward is the claim, a second worker's UPDATE no longer matches
+    now = datetime.datetime.now(datetime.timezone.utc)
+    email_ids = (await db.scalars(update(OutboundEmail).where(
+        OutboundEmail.email_id.in_(due_emails_query(now)), OutboundEmail.status == 'pending',
+        OutboundEmail.next_attempt_at <= now
+    ).values(next_attempt_at=now + datetime.timedelta(seconds=MAIL_CLAIM_TIMEOUT),
+             attempts=OutboundEmail.attempts + 1
+             ).returning(OutboundEmail.email_id).execution_options(synchronize_session=False))).all()
+    await db.commit()
+    if not email_ids:
+        return []
+    return (await db.scalars(select(OutboundEmail).where(
+        OutboundEmail.email_id.in_(email_ids)).order_by(OutboundEmail.email_id))).all()
+
+
+def _attempt_failed(email: OutboundEmail, error: Exception):
+    email.last_error = str(error)
+    if email.attempts >= MAIL_MAX_ATTEMPTS:
+        email.status = 'failed'
+        logger.error('Giving up on email %s to %s: %s', email.email_id, email.recipient, error)
+    else:
+        email.next_attempt_at = datetime.datetime.now(datetime.timezone.utc) + retry_delay(email.attempts)
+
+
+async def deliver_batch(db, emails: list[OutboundEmail], connection) -> int:
+    # aiosmtplib is only imported once there is something to send
+    from .smtp import build_message, CONNECTION_ERRORS, SMTPException
+
+    for index, email in enumerate(emails):
+        try:
+            await connection.send(build_message(email))
+        except CONNECTION_ERRORS as e:
+            for unsent in emails[index:]:
+                _attempt_failed(unsent, e)
+            break
+        except SMTPException as e:
+            _attempt_failed(email, e)
+        else:
+            email.status = 'sent'
+            email.sent_at = datetime.datetime.now(datetime.timezone.utc)
+            email.last_error = None
+    await db.commit()
+    return len(emails)
+
+
+async def run_mail_worker():
+    # Opened with the first batch, a worker that never sends never connects
+    connection = None
+    try:
+        while True:
+            # Cleared first so an email queued during the batch still wakes the next wait
+            _wakeup.clear()
+            delivered = 0
+            try:
+                async with SessionLocal() as db:
+                    emails = await claim_batch(db)
+                    if emails:
+                        if connection is None:
+                            from .smtp import SMTPConnection
+                            connection = SMTPConnection()
+                        delivered = await deliver_batch(db, emails, connection)
+            except Exception:
+                logger.exception('Email delivery failed')
+            if delivered == MAIL_BATCH_SIZE:
+                continue  # More may be waiting
+            if connection is not None and connection.idle_for() > SMTP_IDLE_TIMEOUT:
+                await connection.close()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), MAIL_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if connection is not None:
+            await connection.close()
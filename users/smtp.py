@@ -0,0 +1,72 @@
+import os
+import time
+import asyncio
+from email.message import EmailMessage
+import aiosmtplib
+from aiosmtplib import SMTPException
+from models import OutboundEmail
+
+# Config
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 465))
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_USE_TLS = os.getenv("SMTP_USE_TLS", "true").lower() == "true"
+FROM_EMAIL = os.getenv("FROM_EMAIL")
+MAIL_RATE_LIMIT = float(os.getenv('MAIL_RATE_LIMIT', 5))  # messages per second
+# The server can't be used at all, retrying the rest of the batch now would fail the same way
+CONNECTION_ERRORS = (aiosmtplib.SMTPConnectError, aiosmtplib.SMTPServerDisconnected,
+                     aiosmtplib.SMTPTimeoutError, aiosmtplib.SMTPAuthenticationError, OSError)
+
+
+def build_message(email: OutboundEmail) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = FROM_EMAIL
+    message["To"] = email.recipient
+    message["Subject"] = email.subject
+    message.add_alternative(email.html, subtype='html')
+    return message
+
+
+class SMTPConnection:
+    # One logged-in connection reused across batches, reopened when the server drops it
+    def __init__(self):
+        self._client: aiosmtplib.SMTP | None = None
+        self._last_send = 0.0
+
+    async def _connected(self) -> aiosmtplib.SMTP:
+        if self._client is None or not self._client.is_connected:
+            client = aiosmtplib.SMTP(hostname=SMTP_HOST, port=SMTP_PORT, username=SMTP_USER,
+                                     password=SMTP_PASSWORD, use_tls=SMTP_USE_TLS)
+            try:
+                await client.connect()
+            except aiosmtplib.SMTPException:
+                # A failed login leaves the socket open, don't reuse it unauthenticated
+                client.close()
+                raise
+            self._client = client
+        return self._client
+
+    def idle_for(self) -> float:
+        return time.monotonic() - self._last_send
+
+    async def send(self, message: EmailMessage):
+        # Space the sends out to stay under the provider's rate limit
+        wait = self._last_send + 1 / MAIL_RATE_LIMIT - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_send = time.monotonic()
+        try:
+            await (await self._connected()).send_message(message)
+        except aiosmtplib.SMTPServerDisconnected:
+            # An idle connection the server already closed, retry once on a fresh one
+            self._client = None
+            await (await self._connected()).send_message(message)
+
+    async def close(self):
+        if self._client is not None and self._client.is_connected:
+            try:
+                await self._client.quit()
+            except aiosmtplib.SMTPException:
+                self._client.close()
+        self._client = None
@@ -1,32 +1,42 @@
-from fastapi import APIRouter, status, BackgroundTasks, HTTPException, Depends, Request
+from fastapi import APIRouter, status, HTTPException, Depends, Request
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.responses import HTMLResponse
-from database import db_dependency
-from models import User
-from .email_verification import email_verify, templates
-from .auth import authenticate_user, gen_token, user_dependency, get_email_user
+from database import db_dependency, read_db_dependency
+from models import User, read_columns
+from .email_verification import email_verify, get_templates, VERIFIED_PAGE
+from .mail import notify_mail_worker
+from .auth import authenticate_user, gen_token, user_dependency, get_email_user, hash_password, invalidate_user
 from datetime import timedelta
-from .schemas import UserRequest, Token
+from .schemas import UserRequest, ReadUser, Token
+from .validators import user_uniqueness_errors, validation_error, unique_constraints, UNIQUE_USER_ERRORS
 from typing import Annotated
+from sqlalchemy import select
 
 route = APIRouter(prefix='/user-api', tags=['user'])
 
 
-@route.get('/all')
-async def get_all_users(db: db_dependency):
-    return db.query(User).all()
+@route.get('/all', response_model=list[ReadUser])
+async def get_all_users(db: read_db_dependency):
+    # Only the ReadUser columns are selected, password hashes never leave the database
+    return (await db.execute(select(*read_columns(User, ReadUser)))).mappings().all()
 
 
 @route.post('/signup', status_code=status.HTTP_201_CREATED)
 async def register(user: UserRequest, db: db_dependency):
-    user = User(**user.model_dump())
-    db.add(user)
-    db.commit()
+    errors = await user_uniqueness_errors(user.username, user.email, db)
+    if errors:
+        raise validation_error(errors)
+    values = user.model_dump(exclude={'password'})
+    # Hashing runs after the cheap checks so rejected signups cost no bcrypt work
+    user = User(**values, password=await hash_password(user.password))
+    async with unique_constraints(db, UNIQUE_USER_ERRORS, values):
+        db.add(user)
+        await db.commit()
 
 
 @route.post('/token', response_model=Token)
 async def login(user_form: Annotated[OAuth2PasswordRequestForm, Depends()], db: db_dependency):
-    user = authenticate_user(user_form.username, user_form.password, db)
+    user = await authenticate_user(user_form.username, user_form.password, db)
     if not user:
         raise HTTPException(
             status_code=401, detail='Could not athenticate the user.')
@@ -35,8 +45,10 @@ async def login(user_form: Annotated[OAuth2PasswordRequestForm, Depends()], db:
 
 
 @route.post("/verify-email")
-async def email_verification(user: user_dependency, request: Request, background_tasks: BackgroundTasks, db: db_dependency):
-    background_tasks.add_task(email_verify, user, request, db)
+async def email_verification(user: user_dependency, db: db_dependency):
+    email_verify(user, db)
+    await db.commit()
+    notify_mail_worker()
     return {"message": "Email has been sent in the background"}
 
 
@@ -46,7 +58,8 @@ async def email_verification(token: str, request: Request, db: db_dependency):
     if not user:
         raise HTTPException(
             status_code=401, detail='Could not athenticate the user.')
-    user = db.query(User).filter(User.user_id == user.get('id')).first()
+    user = await db.scalar(select(User).where(User.user_id == user.get('id')))
     user.is_verified = True
-    db.commit()
-    return templates.TemplateResponse(request, 'verified.html', {'username': user.username})
+    await db.commit()
+    invalidate_user(user.user_id)
+    return get_templates().TemplateResponse(request, VERIFIED_PAGE, {'username': user.username})
@@ -1,21 +1,48 @@
+from contextlib import asynccontextmanager
 from password_validator import PasswordValidator
-from database import get_db
+from fastapi.exceptions import RequestValidationError
+from sqlalchemy import select, or_
+from sqlalchemy.exc import IntegrityError
 from models import User
 
 
-def username_validator(username: str):
-    db = next(get_db())
-    errors = []
-    if db.query(User).filter(User.username == username).first():
-        errors.append('Username used before!')
-    return errors
+UNIQUE_USER_ERRORS = {'username': 'Invalid username: Username used before!',
+                      'email': 'Invalid email: Email used before!'}
+
+
+def validation_error(errors: list[tuple[str, str, object]]) -> RequestValidationError:
+    # Same shape pydantic gives a ValueError raised in a field validator
+    return RequestValidationError([{'type': 'value_error', 'loc': ('body', field),
+                                    'msg': f'Value error, {message}', 'input': value}
+                                   for field, message, value in errors])
+
+
+@asynccontextmanager
+async def unique_constraints(db, messages: dict[str, str], values: dict):
+    # The unique constraints are the authority, a concurrent insert that
+    # slips past any pre-check still ends up as a field error
+    try:
+        yield
+    except IntegrityError as e:
+        await db.rollback()
+        # The database names the violated column (sqlite) or constraint (postgres)
+        detail = str(e.orig)
+        errors = [(field, message, values.get(field))
+                  for field, message in messages.items() if field in detail]
+        if not errors:
+            raise
+        raise validation_error(errors) from e
 
 
-def email_validator(email):
-    db = next(get_db())
+async def user_uniqueness_errors(username: str, email: str, db):
+    # One query for both fields so a signup reports every conflict at once
+    rows = (await db.execute(select(User.username, User.email).where(
+        or_(User.username == username, User.email == email)))).all()
     errors = []
-    if db.query(User).filter(User.email == email).first():
-        errors.append('Email used before!')
+    if any(row.username == username for row in rows):
+        errors.append(('username', UNIQUE_USER_ERRORS['username'], username))
+    if any(row.email == email for row in rows):
+        errors.append(('email', UNIQUE_USER_ERRORS['email'], email))
     return errors
 
 